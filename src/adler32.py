@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Lucy Loerker, Maxwell Parker-Blue
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from itertools import accumulate
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Adler-32 is defined in the zlib RFC: https://www.rfc-editor.org/rfc/rfc1950
+
+BASE = 65521
+"""Largest prime smaller than 2**16, which both sums are taken modulo."""
+NMAX = 5552
+"""Most bytes that can be summed before the sums could overflow 32 bits.
+
+We don't have that problem with Python integers, but taking the modulo only
+once per block of this size keeps the sums small without doing it per byte."""
+VECTORIZE_MIN = 2**16
+"""Smallest input that is worth handing over to NumPy."""
+VECTORIZE_BLOCK = 2**16
+"""Number of bytes summed at a time by NumPy.
+
+With this many bytes, the weighted sum stays well within 64 bits."""
+
+
+def _adler32_numpy(data, a, b):
+    weights = np.arange(VECTORIZE_BLOCK, 0, -1, dtype=np.int64)
+    arr = np.frombuffer(data, dtype=np.uint8)
+    for start in range(0, len(arr), VECTORIZE_BLOCK):
+        block = arr[start : start + VECTORIZE_BLOCK]
+        n = len(block)
+        b = (b + n * a + int(np.dot(block, weights[VECTORIZE_BLOCK - n :]))) % BASE
+        a = (a + int(block.sum(dtype=np.int64))) % BASE
+    return a, b
+
+
+def adler32(data, value=1):
+    """Computes the Adler-32 checksum of some data.
+
+    To checksum data that comes in pieces, pass the checksum of everything
+    before it as value.
+
+    Each byte adds to a, and each byte's a adds to b, so over a block of n bytes
+    b grows by n times the starting a, plus the sum of the running sums of the
+    bytes. That way, both sums can be computed with builtins that loop in C,
+    rather than stepping through the bytes in Python."""
+    a = value & 0xFFFF
+    b = value >> 16
+    data = memoryview(data).cast("B")
+    if np is not None and len(data) >= VECTORIZE_MIN:
+        a, b = _adler32_numpy(data, a, b)
+        return b << 16 | a
+    for start in range(0, len(data), NMAX):
+        block = data[start : start + NMAX]
+        b = (b + len(block) * a + sum(accumulate(block))) % BASE
+        a = (a + sum(block)) % BASE
+    return b << 16 | a
+
+
+def adler32_combine(adler1, adler2, len2):
+    """Computes the checksum of two pieces of data from each of their checksums.
+
+    adler2 started from a = 1, b = 0 rather than from adler1. Starting from
+    adler1 instead adds (a1 - 1) to every running sum, so to a once and to b
+    once per byte of the second piece."""
+    a1 = adler1 & 0xFFFF
+    b1 = adler1 >> 16
+    a2 = adler2 & 0xFFFF
+    b2 = adler2 >> 16
+    a = (a1 + a2 - 1) % BASE
+    b = (b1 + b2 + len2 * (a1 - 1)) % BASE
+    return b << 16 | a
+
+
+def main():
+    import os
+    import zlib
+
+    print("Test Adler-32 against zlib:")
+    data = os.urandom(3 * VECTORIZE_BLOCK + 12345)
+    for size in [0, 1, NMAX - 1, NMAX, NMAX + 1, 100_000, len(data)]:
+        assert adler32(data[:size]) == zlib.adler32(data[:size]), size
+
+    print("Test incremental Adler-32:")
+    value = adler32(b"")
+    for start in range(0, len(data), 7777):
+        value = adler32(data[start : start + 7777], value)
+    assert value == zlib.adler32(data)
+    print(hex(value))
+
+    print("Test combining Adler-32s:")
+    for split in [0, 1, 12345, len(data)]:
+        a, b = data[:split], data[split:]
+        assert adler32_combine(adler32(a), adler32(b), len(b)) == zlib.adler32(data)
+
+
+if __name__ == "__main__":
+    exit(main())
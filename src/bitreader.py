@@ -5,101 +5,118 @@
 
 
 class BitReader:
-    """Utility for reading bits from a file-like object.
+    """Utility for reading bits from a bytes-like object.
 
     The OS I/O APIs, as well as the Python wrappers for them, do not support
     reading and writing with low granulaity. With some extra state, though,
     we can provide a nice interface that lets us think in bits.
 
-    Reading past the end is UB (but will probably throw an exception).
+    The data can be anything supporting the buffer protocol (bytes, bytearray,
+    memoryview, mmap, ...). It is never copied: bits are loaded from it several
+    bytes at a time into an integer bit buffer, and aligned reads hand back
+    views into it.
     """
 
-    def __init__(self, f):
-        self.f = f
-        """File being read from."""
-        self.working_byte = None
-        """Last byte read from the file.
-        
-        Populated if and only if there is a nonzero bit offset."""
-        self.bit_offset = 0
-        """Number of least significant bits consumed within the current byte.
-        
-        When we read a whole byte, this should remain the same.
-        """
-
-    def read_bits(self, bits_needed):
-        """Read bits from the file."""
-        data = bytearray()
-        if bits_needed >= 8:
-            data += self.read_bytes(bits_needed // 8)
-            bits_needed = bits_needed % 8
-        if bits_needed == 0:
-            return data
-        last_byte = 0
-        # If we are byte-aligned, life is good (for now).
-        if self.working_byte is None:
-            self.working_byte = self.f.read(1)[0]
-            self.bit_offset = bits_needed
-            last_byte = self.working_byte & (2**self.bit_offset - 1)
-            data.append(last_byte)
-            return data
-        bits_remaining = 8 - self.bit_offset
-        # The mask produced by bits_needed may be wider than
-        # the remaining bits, which is harmless. It still is necessary
-        # in the event that it's *smaller* than the remaining bits.
-        last_byte |= (self.working_byte >> self.bit_offset) & (2**bits_needed - 1)
-        # If we did not use the whole working byte.
-        if bits_needed < bits_remaining:
-            self.bit_offset += bits_needed
-        # If we happened to end up byte-aligned.
-        elif bits_needed == bits_remaining:
-            self.working_byte = None
-            self.bit_offset = 0
-        # If we have depleted the working byte, and need a new one.
-        else:
-            bits_needed -= bits_remaining
-            self.working_byte = self.f.read(1)[0]
-            # Note the equivalence of this to the high bits when we read a byte.
-            last_byte |= (self.working_byte & (2**bits_needed - 1)) << bits_remaining
-            self.bit_offset = bits_needed
-        data.append(last_byte)
-        return data
-
-    def _read_byte(self, next_byte):
-        """Read a byte from the file, assuming that the bit offset is nonzero."""
-        low_bits = self.working_byte >> self.bit_offset
-        self.working_byte = next_byte
-        high_bits = (self.working_byte & (2**self.bit_offset - 1)) << (
-            8 - self.bit_offset
-        )
-        return low_bits | high_bits
-
-    def read_byte(self):
-        """Read a byte from the file, with the potential that the bit offset
-        is nonzero."""
-        if self.working_byte is None:
-            assert self.bit_offset == 0
-            return bytes((self.f.read(1)[0],))
-        return bytes((self._read_byte(self.f.read(1)[0]),))
-
-    def read_bytes(self, size):
-        """Read multiple bytes from the file"""
-        data = self.f.read(size)
-        if self.working_byte is None or not data:
-            assert self.bit_offset == 0
-            self.working_byte = None
-            self.bit_offset = 0
-            return data
-        ret = bytearray()
-        for byte in data:
-            ret += self._read_byte(byte)
-        self.working_byte = ret[-1]
-        return ret
+    def __init__(self, data=b""):
+        self.data = memoryview(data).cast("B")
+        """Data being read from."""
+        self.pos = 0
+        """Offset of the next byte to be loaded into the bit buffer."""
+        self.bit_buf = 0
+        """Bits that have been loaded from the data, but not consumed.
+
+        The next bit to be consumed is the least significant one."""
+        self.bit_count = 0
+        """Number of bits in bit_buf."""
+
+    def feed(self, data):
+        """Appends more data to be read.
+
+        Only the data that has not been consumed yet is kept (and copied)."""
+        # Whole bytes loaded into the bit buffer carry over into the new data.
+        self._put_back()
+        if self.pos < len(self.data):
+            data = bytes(self.data[self.pos :]) + data
+        self.data = memoryview(data).cast("B")
+        self.pos = 0
+
+    def unload(self):
+        """Gives back the data that has not been consumed yet.
+
+        Less than a byte of bits may have been consumed from the first byte, so
+        they are kept in the bit buffer, and the rest is removed and returned."""
+        self._put_back()
+        rest = bytes(self.data[self.pos :])
+        self.data = memoryview(b"")
+        self.pos = 0
+        return rest
+
+    def _refill(self):
+        """Loads as many whole bytes as will fit in 64 bits."""
+        num_bytes = (64 - self.bit_count) >> 3
+        chunk = self.data[self.pos : self.pos + num_bytes]
+        self.bit_buf |= int.from_bytes(chunk, "little") << self.bit_count
+        self.bit_count += 8 * len(chunk)
+        self.pos += len(chunk)
+
+    def _put_back(self):
+        """Puts the whole bytes in the bit buffer back into the data.
+
+        Only the bits left of a partly consumed byte stay in the bit buffer."""
+        self.pos -= self.bit_count >> 3
+        self.bit_count &= 0b111
+        self.bit_buf &= (1 << self.bit_count) - 1
+
+    def bits_left(self):
+        """Returns the number of bits that have yet to be consumed."""
+        return self.bit_count + 8 * (len(self.data) - self.pos)
+
+    def peek(self, bits_needed):
+        """Look at upcoming bits without consuming them.
+
+        Past the end of the data, the bits read as zeros. At most 57 bits can be
+        peeked at once."""
+        if self.bit_count < bits_needed:
+            self._refill()
+        return self.bit_buf & ((1 << bits_needed) - 1)
+
+    def consume(self, bits_needed):
+        """Consume bits that have already been peeked at."""
+        if bits_needed > self.bit_count:
+            raise EOFError("read past end of data")
+        self.bit_buf >>= bits_needed
+        self.bit_count -= bits_needed
+
+    def read_int(self, bits_needed):
+        """Read bits as an integer, least significant bit first."""
+        if self.bit_count < bits_needed:
+            self._refill()
+            if self.bit_count < bits_needed:
+                raise EOFError("read past end of data")
+        value = self.bit_buf & ((1 << bits_needed) - 1)
+        self.bit_buf >>= bits_needed
+        self.bit_count -= bits_needed
+        return value
+
+    def align(self):
+        """Skip to the start of the next byte, if not already there."""
+        self.consume(self.bit_count % 8)
+
+    def read_aligned(self, size):
+        """Read whole bytes, starting from the next byte boundary.
+
+        Returns a view into the data, rather than a copy."""
+        self.align()
+        # After aligning, nothing is left in the bit buffer once whole bytes are
+        # put back, so the data can be sliced from where we really are.
+        self._put_back()
+        if self.pos + size > len(self.data):
+            raise EOFError("read past end of data")
+        self.pos += size
+        return self.data[self.pos - size : self.pos]
 
 
 def main():
-    import io
-
     def bindump(data):
         print("".join("{:#010b} ".format(x) for x in data))
 
@@ -107,45 +124,61 @@ def main():
 
     print("Test 1: Reading bits across boundaries\nData:")
     bindump(data)
-    data1 = data[:]
-    br1 = BitReader(io.BytesIO(data1))
-    actual1 = bytearray()
-    actual1 = br1.read_bits(2)
-    assert actual1[0] == 0b01
-    actual1 = br1.read_bits(3)
-    assert actual1[0] == 0b110
-    actual1 = br1.read_bits(5)
-    assert actual1[0] == 0b11001
-    actual1 = br1.read_bits(6)
+    br1 = BitReader(data)
+    assert br1.read_int(2) == 0b01
+    assert br1.read_int(3) == 0b110
+    assert br1.read_int(5) == 0b11001
+    assert br1.read_int(6) == 0b101001
+    assert br1.bits_left() == 0
 
     print("Test 2: Reading bytes\nData:")
     bindump(data)
-    data2 = data[:]
-    br2 = BitReader(io.BytesIO(data2))
-    actual2 = bytearray()
-    actual2 = br2.read_bytes(2)
-    assert actual2 == data
+    br2 = BitReader(data)
+    assert br2.read_aligned(2) == data
 
-    print("Test 3: Reading bytes (alt)\nData:")
+    print("Test 3: Peeking past the end\nData:")
+    bindump(data)
+    br3 = BitReader(data)
+    assert br3.peek(20) == 0b1010_0111_0011_1001
+    br3.consume(16)
+    try:
+        br3.consume(1)
+        assert False, "consumed past end"
+    except EOFError:
+        pass
+
+    print("Test 4: Reading mixed bits and bytes\nData:")
     bindump(data)
-    data3 = data[:]
-    br3 = BitReader(io.BytesIO(data3))
-    actual3 = bytearray()
-    actual3 = br3.read_byte()
-    actual3 += br3.read_byte()
-    assert actual3 == data
-
-    print("Test 4: Reading mixed bits and bytes (alt)\nData:")
+    br4 = BitReader(bytearray(data + data))
+    assert br4.read_int(4) == 0b1001
+    assert br4.read_int(8) == 0b0111_0011
+    aligned = br4.read_aligned(2)
+    assert aligned == data
+    assert type(aligned) is memoryview
+
+    print("Test 5: Feeding and unloading\nData:")
     bindump(data)
-    data3 = data[:]
-    br4 = BitReader(io.BytesIO(data1))
-    actual4 = bytearray()
-    actual4 = br4.read_bits(4)
-    assert actual4[0] == 0b1001
-    actual4 = br4.read_byte()
-    assert actual4[0] == 0b0111_0011
-    actual4 = br4.read_bits(4)
-    assert actual4[0] == 0b1010
+    br5 = BitReader(data[:1])
+    assert br5.read_int(4) == 0b1001
+    try:
+        br5.read_int(8)
+        assert False, "read past end"
+    except EOFError:
+        pass
+    br5.feed(data[1:])
+    assert br5.read_int(8) == 0b0111_0011
+    assert br5.unload() == b""
+    br5.feed(data)
+    assert br5.read_int(4) == 0b1010
+    assert br5.unload() == data
+
+    print("Test 6: Feeding with whole bytes in the bit buffer\nData:")
+    bindump(data + data)
+    br6 = BitReader(data)
+    assert br6.read_int(1) == 0b1
+    br6.feed(data)
+    assert br6.read_aligned(2) == data[1:] + data[:1]
+    assert br6.unload() == data[1:]
 
     return 0
 
@@ -4,104 +4,90 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 
-import math
-
-
 class BitWriter:
     """Utility for writing bits to a file-like object.
 
-    This is largely based off of BitReader.
+    This is largely based off of BitReader. Bits are collected in an integer,
+    and moved into a byte buffer a few bytes at a time. The buffer is only
+    written to the file once it gets large, or when flushed, so that we are not
+    making a call to write for every byte.
     """
 
+    BUFFER_SIZE = 2**16
+    """Number of buffered bytes at which we write to the file."""
+
     def __init__(self, f):
         self.f = f
         """File being written to from."""
-        self.working_byte = None
-        # TODO: add a flush method
-        """Work-in-progress byte to be written.
-        
-        Populated if and only if there is a nonzero bit offset."""
-        self.bit_offset = 0
-        """Number of least significant bits written to current WIP byte.
-        
-        When we write a whole byte, this should remain the same.
-        """
+        self.bit_buf = 0
+        """Bits that have been written, but not yet moved into buf.
+
+        The first bit to be written out is the least significant one."""
+        self.bit_count = 0
+        """Number of bits in bit_buf."""
+        self.buf = bytearray()
+        """Whole bytes that have yet to be written to the file."""
 
     def __del__(self):
         self.flush()
 
+    def _drain(self):
+        """Moves all of the whole bytes in bit_buf into buf."""
+        num_bytes = self.bit_count >> 3
+        self.buf += (self.bit_buf & ((1 << 8 * num_bytes) - 1)).to_bytes(
+            num_bytes, "little"
+        )
+        self.bit_buf >>= 8 * num_bytes
+        self.bit_count &= 0b111
+        if len(self.buf) >= self.BUFFER_SIZE:
+            self.f.write(self.buf)
+            self.buf = bytearray()
+
     def flush(self):
-        if self.working_byte is None:
-            return
-        self.f.write(bytes((self.working_byte,)))
-        self.working_byte = None
-        self.bit_offset = 0
+        """Write out everything, padding the last byte with zeros if needed."""
+        self._drain()
+        if self.bit_count:
+            self.buf.append(self.bit_buf)
+            self.bit_buf = 0
+            self.bit_count = 0
+        if self.buf:
+            self.f.write(self.buf)
+            self.buf = bytearray()
+
+    def align(self):
+        """Pad with zeros up to the next byte boundary, if not already there."""
+        self.bit_count += -self.bit_count % 8
+        self._drain()
 
     def write_bits(self, data, bits_needed):
         """Write bits to the file.
 
-        bits_needed is the number of bits left to write."""
-        # print(f"write_bits({data:0{bits_needed}b})")
-        if type(data) != bytes:
-            data = data.to_bytes(math.ceil(bits_needed / 8), "little")
-        if bits_needed % 8 == 0:
-            self.write_bytes(data)
-            return
-        if bits_needed >= 8:
-            self.write_bytes(data[:-1])
-            bits_needed = bits_needed % 8
-        data = data[-1]
-        # If we are byte-aligned, life is good (for now).
-        if self.working_byte is None:
-            self.working_byte = data
-            self.bit_offset = bits_needed
-            # (we cannot write yet - the user must keep writing, or flush)
-            return
-        bits_remaining = 8 - self.bit_offset
-        last_byte = self.working_byte
-        last_byte |= (data & 2**bits_needed - 1) << self.bit_offset
-        # Account for mask being too wide (filled working byte).
-        last_byte &= 2**8 - 1
-        # If we did not fill the whole working byte.
-        if bits_needed < bits_remaining:
-            self.working_byte = last_byte
-            self.bit_offset += bits_needed
-            # (we cannot write yet)
-        # If we happened to end up byte-aligned.
-        elif bits_needed == bits_remaining:
-            self.working_byte = None
-            self.bit_offset = 0
-            self.f.write(bytes((last_byte,)))
-        # If we have filled the working byte, and need a new one.
-        else:
-            self.f.write(bytes((last_byte,)))
-            self.working_byte = data >> bits_remaining
-            self.bit_offset = bits_needed - bits_remaining
-
-    def _write_byte(self, next_byte):
-        low_bits = self.working_byte
-        high_bits = (next_byte & (2 ** (8 - self.bit_offset) - 1)) << (self.bit_offset)
-        self.working_byte = next_byte >> (8 - self.bit_offset)
-        self.f.write(bytes((low_bits | high_bits,)))
+        data may be an int, which must fit in bits_needed bits, or a bytes-like,
+        of which only the lowest bits_needed bits are written."""
+        if not isinstance(data, int):
+            data = int.from_bytes(data, "little") & ((1 << bits_needed) - 1)
+        self.bit_buf |= data << self.bit_count
+        self.bit_count += bits_needed
+        if self.bit_count >= 64:
+            self._drain()
 
     def write_byte(self, byte):
         """Writes a byte to the file.
 
         byte should be a bytes-like."""
-        if self.working_byte is None:
-            assert self.bit_offset == 0
-            self.f.write(byte)
-        else:
-            self._write_byte(byte)
+        self.write_bytes(byte)
 
     def write_bytes(self, data):
         """Write multiple bytes to the file."""
-        if self.working_byte is None:
-            assert self.bit_offset == 0
-            self.f.write(data)
+        if self.bit_count % 8 == 0:
+            self._drain()
+            self.buf += data
+            if len(self.buf) >= self.BUFFER_SIZE:
+                self.f.write(self.buf)
+                self.buf = bytearray()
             return
-        for byte in data:
-            self._write_byte(byte)
+        self.write_bits(int.from_bytes(data, "little"), 8 * len(data))
+        self._drain()
 
 
 def main():
@@ -151,6 +137,22 @@ def main():
     bindump(f3out)
     assert f3out == data
 
+    print("Test 4: Writing ints across boundaries, then bytes\nData:")
+    f4 = io.BytesIO()
+    bw4 = BitWriter(f4)
+    bw4.write_bits(0b001, 3)
+    bw4.write_bits(0b0111, 4)
+    bw4.write_bits(0b01110, 5)
+    bw4.write_bits(0b1010, 4)
+    bw4.write_bytes(data)
+    bw4.write_bits(0b1, 1)
+    bw4.write_bytes(data)
+    bw4.flush()
+    f4.seek(0)
+    f4out = f4.read()
+    bindump(f4out)
+    assert f4out == data + data + bytes((0b0111_0011, 0b0100_1110, 0b1))
+
     return 0
 
 
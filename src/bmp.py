@@ -3,9 +3,18 @@
 # Copyright 2023 Lucy Loerker, Maxwell Parker-Blue
 # SPDX-License-Identifier: GPL-2.0-or-later
 
+import io
+import mmap
 import struct
 from dataclasses import dataclass
 
+from pixelbuffer import PixelBuffer
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 @dataclass
 class Bmp:
@@ -78,6 +87,26 @@ class Bmp:
                 self.important_colors,
             ) = struct.unpack(self.FMT, data.read(self.dib_size - 4))
 
+        def check_supported(self):
+            """Raises ValueError if the pixel array is in a format we can't read."""
+            if self.bpp != 24:
+                raise ValueError(
+                    "only 24 bits per pixel currently supported, "
+                    + "will not create pixel array"
+                )
+            if self.compression == 4:
+                raise ValueError(
+                    "that...that's a jpeg. you took a jpeg and gave it a bmp header. "
+                    + "go sit in the corner and think about what you've done."
+                )
+            if self.compression == 5:
+                raise ValueError(
+                    "that...that's a png. you took a png and gave it a bmp header."
+                    + "go sit in the corner and think about what you've done."
+                )
+            if self.compression != 0:
+                raise ValueError("this program only works for uncompressed bitmaps")
+
         def __bytes__(self):
             data = bytearray()
             data += struct.pack("<I", 40) + struct.pack(
@@ -95,93 +124,116 @@ class Bmp:
             )
             return bytes(data)
 
-    def __init__(self, filename=None, file=None, reference_image=None):
+    def __init__(self, filename=None, file=None, reference_image=None, use_mmap=False):
         if filename is not None:
             with open(filename, "rb") as in_file:
-                self.process(in_file)
+                self.process(in_file, use_mmap)
         elif file is not None:
-            self.process(file)
+            self.process(file, use_mmap)
         elif reference_image is not None:
             self.generate(reference_image)
 
-    def process(self, in_file):
+    def process(self, in_file, use_mmap=False):
+        """Reads a BMP from a file.
+
+        If use_mmap is set, the pixel array is converted straight out of the
+        mapped file, rather than reading the whole file into memory first."""
         self.header = self.Header(data=in_file)
         self.dib = self.Dib(data=in_file)
-        in_file.seek(self.header.offset)
-        image = in_file.read()
-        if self.dib.bpp != 24:
-            raise ValueError(
-                "only 24 bits per pixel currently supported, "
-                + "will not create pixel array"
-            )
-        if self.dib.compression == 4:
-            raise ValueError(
-                "that...that's a jpeg. you took a jpeg and gave it a bmp header. "
-                + "go sit in the corner and think about what you've done."
-            )
-        if self.dib.compression == 5:
-            raise ValueError(
-                "that...that's a png. you took a png and gave it a bmp header."
-                + "go sit in the corner and think about what you've done."
-            )
-        if self.dib.compression != 0:
-            raise ValueError("this program only works for uncompressed bitmaps")
-        # now stores pixels as [x][y] from top to bottom
-        self.arr = []
-        for x in range(self.dib.width):
-            self.arr.append([])
-            for y in range(self.dib.height):
-                self.arr[x].append([])
+        self.dib.check_supported()
+        if use_mmap:
+            with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as image:
+                    self._read_pixels(image[self.header.offset :])
+        else:
+            in_file.seek(self.header.offset)
+            self._read_pixels(in_file.read())
+
+    def _read_pixels(self, image):
         # NOTE: colors are stored as (red, green, blue) for png parity
         # MAKE SURE TO REVERSE THIS WHEN MAKING NEW BMP FILES
-        rowSize = int((self.dib.bpp * self.dib.width + 31) / 32) * 4
-        for y in range(self.dib.height):
-            row = y * rowSize
-            for x in range(self.dib.width):
-                self.arr[x][self.dib.height - 1 - y] = (
-                    int(image[row + (x * 3) + 2]),
-                    int(image[row + (x * 3) + 1]),
-                    int(image[row + (x * 3)]),
-                )
+        width = self.dib.width
+        # A negative height means that the rows are stored from top to bottom.
+        height = abs(self.dib.height)
+        self.pixels = PixelBuffer(width, height)
+        row_size = self.pixels.row_size
+        stride = row_stride(width, self.dib.bpp)
+        if len(image) < stride * (height - 1) + row_size:
+            raise ValueError("pixel array is truncated")
+        if np is not None:
+            # The last row doesn't have to be padded, so rather than reshaping
+            # stride * height bytes, view the pixels with strides.
+            src = np.ndarray(
+                (height, width, 3), np.uint8, image, strides=(stride, 3, 1)
+            )
+            if self.dib.height > 0:
+                src = src[::-1]
+            self.pixels.to_numpy()[:] = src[:, :, ::-1]
+            return
+        data = self.pixels.data
+        for y in range(height):
+            row = image[y * stride : y * stride + row_size]
+            dest = y if self.dib.height < 0 else height - 1 - y
+            start = dest * row_size
+            end = start + row_size
+            data[start:end:3] = row[2::3]
+            data[start + 1 : end : 3] = row[1::3]
+            data[start + 2 : end : 3] = row[0::3]
 
     def generate(self, reference_image):
-        width = len(reference_image)
-        height = len(reference_image[0])
-        # img_size = height*int((24*width+31)/32)+4
-        self.header = self.Header(size=0)
-        self.dib = self.Dib(width=width, height=height, img_size=0)
-        self.arr = reference_image
-        self.header.size = len(bytes(self))
-        self.dib.img_size = self.header.size - (
-            len(bytes(self.header)) + len(bytes(self.dib))
-        )
+        width = reference_image.width
+        height = reference_image.height
+        img_size = height * row_stride(width)
+        self.header = self.Header(size=54 + img_size)
+        self.dib = self.Dib(width=width, height=height, img_size=img_size)
+        self.pixels = reference_image
+
+    def row_bytes(self, y):
+        """Packs a row of pixels as it is stored in the file, padding included."""
+        row = self.pixels.row(y)
+        channels = self.pixels.channels
+        row_size = 3 * self.pixels.width
+        data = bytearray(row_stride(self.pixels.width))
+        if channels < 3:
+            # Grayscale, possibly with alpha.
+            gray = row[::channels]
+            data[0:row_size:3] = data[1:row_size:3] = data[2:row_size:3] = gray
+        else:
+            data[0:row_size:3] = row[2::channels]
+            data[1:row_size:3] = row[1::channels]
+            data[2:row_size:3] = row[0::channels]
+        return data
+
+    def write_to(self, f):
+        """Writes the BMP to a file, one row at a time."""
+        written = f.write(bytes(self.header))
+        written += f.write(bytes(self.dib))
+        if self.header.offset > written:
+            written += f.write(bytes(self.header.offset - written))
+        rows = range(self.pixels.height)
+        for y in rows if self.dib.height < 0 else reversed(rows):
+            written += f.write(self.row_bytes(y))
+        if self.header.size > written:
+            f.write(bytes(self.header.size - written))
 
     def __bytes__(self):
-        data = bytearray()
-        data += bytes(self.header)
-        data += bytes(self.dib)
-        padding = "x" * ((self.dib.width * 3) % 4)
-        for y in reversed(range(self.dib.height)):
-            for x in range(self.dib.width):
-                data += struct.pack(
-                    "<BBB", self.arr[x][y][2], self.arr[x][y][1], self.arr[x][y][0]
-                )
-            data += struct.pack(padding)
-        extra = self.header.size - len(data)
-        if extra > 0:
-            data += struct.pack("x" * extra)
-        return bytes(data)
+        data = io.BytesIO()
+        self.write_to(data)
+        return data.getvalue()
+
+
+def row_stride(width, bpp=24):
+    """Computes the size of a row in the pixel array, which is padded to 4 bytes."""
+    return (bpp * width + 31) // 32 * 4
 
 
 if __name__ == "__main__":
-    image = []
+    image = PixelBuffer(200, 200)
     for x in range(200):
-        image.append([])
         for y in range(200):
-            image[x].append((x % (y + 1), y % (x + 1), int((x + y) / 2)))
+            image[x, y] = (x % (y + 1), y % (x + 1), int((x + y) / 2))
     bmp = Bmp(reference_image=image)
     # bmp = Bmp(filename="sample/bulbasaur.bmp")
-    # new_bmp = Bmp(reference_image=bmp.arr)
-    output = open("sample/example_gradient.bmp", "wb")
-    output.write(bytes(bmp))
-    output.close()
+    # new_bmp = Bmp(reference_image=bmp.pixels)
+    with open("sample/example_gradient.bmp", "wb") as output:
+        bmp.write_to(output)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Lucy Loerker, Maxwell Parker-Blue
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import mmap
+import os
+import time
+
+import lz77
+import zlib_
+from bmp import Bmp, row_stride
+from filters import FilterType, Heuristic, iter_filtered
+from png import IDAT_SIZE, Png
+
+# Converting a whole image at once means holding the pixels, the filtered data
+# and the compressed data in memory all together. Here, each row is read, filtered
+# and compressed in turn, and compressed data is written out in IDAT chunks as
+# soon as there is enough of it, so only a couple of rows and the compressor's
+# window are held at a time.
+
+
+def _bmp_rows(in_file, header, dib, use_mmap=False):
+    """Yields the rows of a BMP's pixel array from top to bottom, as RGB.
+
+    BMPs are usually stored from bottom to top, so rather than reading the file
+    in order, we seek to each row (or index into the mapped file)."""
+    width = dib.width
+    height = abs(dib.height)
+    row_size = 3 * width
+    stride = row_stride(width, dib.bpp)
+    mm = image = None
+    if use_mmap:
+        mm = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        image = memoryview(mm)
+    try:
+        for y in range(height):
+            start = header.offset + stride * (y if dib.height < 0 else height - 1 - y)
+            if image is not None:
+                row = image[start : start + row_size]
+            else:
+                in_file.seek(start)
+                row = in_file.read(row_size)
+            if len(row) < row_size:
+                raise ValueError("pixel array is truncated")
+            rgb = bytearray(row_size)
+            rgb[0::3] = row[2::3]
+            rgb[1::3] = row[1::3]
+            rgb[2::3] = row[0::3]
+            del row
+            yield rgb
+    finally:
+        if image is not None:
+            image.release()
+            mm.close()
+
+
+def _write_idats(out_file, data, final=False):
+    """Writes out as many full IDAT chunks as there are in data, or all of it.
+
+    Whatever has been written is removed from the start of data."""
+    while len(data) >= IDAT_SIZE or (final and data):
+        chunk = Png.Chunk(data=bytes(data[:IDAT_SIZE]), chunk_type=b"IDAT")
+        out_file.write(bytes(chunk))
+        del data[:IDAT_SIZE]
+
+
+def bmp_to_png(
+    in_file,
+    out_file,
+    level=zlib_.Z_DEFAULT_COMPRESSION,
+    heuristic=Heuristic.MIN_SUM,
+    filter_type=FilterType.NONE,
+    use_mmap=False,
+    jobs=1,
+    strategy=zlib_.Z_FILTERED,
+):
+    """Converts a BMP read from one file into a PNG written to another.
+
+    If jobs is more than 1, compression is split across that many processes."""
+    header = Bmp.Header(data=in_file)
+    if not header.valid:
+        raise ValueError("not a BMP file")
+    dib = Bmp.Dib(data=in_file)
+    dib.check_supported()
+    out_file.write(bytes(Png.Header()))
+    out_file.write(bytes(Png.Ihdr(width=dib.width, height=abs(dib.height))))
+    # Each row is preceded by its filter type byte.
+    probes = lz77.image_distances(3 * dib.width + 1, 3)
+    if jobs == 1:
+        compressor = zlib_.Compressor(level, strategy=strategy, probe_distances=probes)
+    else:
+        compressor = zlib_.ParallelCompressor(
+            level, jobs=jobs, strategy=strategy, probe_distances=probes
+        )
+    try:
+        idat = bytearray()
+        rows = _bmp_rows(in_file, header, dib, use_mmap)
+        for line in iter_filtered(rows, 3, heuristic, filter_type):
+            idat += compressor.compress(line)
+            _write_idats(out_file, idat)
+        idat += compressor.flush()
+    finally:
+        if jobs != 1:
+            # Otherwise a broken BMP would leave the processes behind.
+            compressor.close()
+    _write_idats(out_file, idat, final=True)
+    out_file.write(bytes(Png.Chunk()))
+
+
+def png_to_bmp(filename, out_file):
+    """Converts a PNG read from a file into a BMP written to another.
+
+    Unlike the other way around, the whole image is decoded first. Any alpha
+    channel is dropped, since BMPs are written with 24 bits per pixel."""
+    png = Png(filename=filename)
+    Bmp(reference_image=png.pixels).write_to(out_file)
+
+
+def output_filename(filename, out_dir=None):
+    """Names the file that a BMP or PNG is converted to, swapping the extension."""
+    root, ext = os.path.splitext(filename)
+    match ext.lower():
+        case ".bmp":
+            root += ".png"
+        case ".png":
+            root += ".bmp"
+        case _:
+            raise ValueError(f"don't know how to convert {filename}")
+    if out_dir is not None:
+        root = os.path.join(out_dir, os.path.basename(root))
+    return root
+
+
+def convert_file(src, dst, level=zlib_.Z_DEFAULT_COMPRESSION):
+    """Converts a BMP file to a PNG file, or the other way around.
+
+    The output is written under a temporary name and then moved into place, so
+    that an interrupted conversion never leaves behind a file that looks done.
+    Returns the size of the input, the size of the output, and the time taken."""
+    start = time.perf_counter()
+    tmp = dst + ".tmp"
+    try:
+        with open(tmp, "wb") as out_file:
+            if os.path.splitext(src)[1].lower() == ".png":
+                png_to_bmp(src, out_file)
+            else:
+                with open(src, "rb") as in_file:
+                    bmp_to_png(in_file, out_file, level)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return os.path.getsize(src), os.path.getsize(dst), time.perf_counter() - start
+
+
+def main():
+    import tempfile
+
+    print("Test converting a BMP to a PNG:")
+    sample = os.path.join(os.path.dirname(__file__), "../sample/bulbasaur.bmp")
+    bmp = Bmp(filename=sample)
+    with tempfile.TemporaryDirectory() as tmp:
+        for use_mmap, jobs in [(False, 1), (True, 1), (False, 2)]:
+            filename = os.path.join(tmp, "bulbasaur.png")
+            with open(sample, "rb") as in_file, open(filename, "wb") as out_file:
+                bmp_to_png(in_file, out_file, use_mmap=use_mmap, jobs=jobs)
+            assert Png(filename=filename).pixels == bmp.pixels
+
+    print("Test converting a PNG to a BMP and back:")
+    with tempfile.TemporaryDirectory() as tmp:
+        png = os.path.join(tmp, "bulbasaur.png")
+        convert_file(sample, png)
+        back = os.path.join(tmp, "back.bmp")
+        convert_file(png, back)
+        assert Bmp(filename=back).pixels == bmp.pixels
+        assert output_filename(png, "out") == os.path.join("out", "bulbasaur.bmp")
+
+
+if __name__ == "__main__":
+    exit(main())
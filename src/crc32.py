@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Lucy Loerker, Maxwell Parker-Blue
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import math
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# CRC-32 as used by PNG is defined in: https://www.w3.org/TR/png/#D-CRCAppendix
+
+POLY = 0xEDB88320
+"""CRC-32 polynomial, bit-reversed (so that the lowest bit is x^31)."""
+VECTORIZE_MIN = 2**16
+"""Smallest input that is worth handing over to NumPy."""
+
+
+def _make_tables():
+    """Constructs the tables for slicing-by-8.
+
+    tables[0] is the usual table, giving the CRC of each byte. tables[k] gives the
+    CRC of each byte followed by k zero bytes, so that 8 bytes can be processed
+    with 8 independent lookups."""
+    table = []
+    for n in range(256):
+        c = n
+        for _ in range(8):
+            if c & 1:
+                c = POLY ^ (c >> 1)
+            else:
+                c >>= 1
+        table.append(c)
+    tables = [table]
+    for _ in range(7):
+        prev = tables[-1]
+        tables.append([(c >> 8) ^ table[c & 0xFF] for c in prev])
+    return tables
+
+
+tables = _make_tables()
+
+
+def _crc32_sliced(data, crc):
+    """Updates a CRC (without pre/post-conditioning) 8 bytes at a time."""
+    t0, t1, t2, t3, t4, t5, t6, t7 = tables
+    num_words = len(data) // 8
+    for lo, hi in struct.iter_unpack("<II", data[: 8 * num_words]):
+        lo ^= crc
+        crc = (
+            t7[lo & 0xFF]
+            ^ t6[lo >> 8 & 0xFF]
+            ^ t5[lo >> 16 & 0xFF]
+            ^ t4[lo >> 24]
+            ^ t3[hi & 0xFF]
+            ^ t2[hi >> 8 & 0xFF]
+            ^ t1[hi >> 16 & 0xFF]
+            ^ t0[hi >> 24]
+        )
+    for byte in data[8 * num_words :]:
+        crc = t0[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc
+
+
+def _multmodp(a, b):
+    """Multiplies two polynomials modulo the CRC polynomial."""
+    m = 1 << 31
+    p = 0
+    while m:
+        if a & m:
+            p ^= b
+            if a & (m - 1) == 0:
+                break
+        m >>= 1
+        b = (b >> 1) ^ POLY if b & 1 else b >> 1
+    return p
+
+
+def _x8nmodp(n):
+    """Computes x^(8n) modulo the CRC polynomial (n zero bytes' worth)."""
+    p = 1 << 31
+    x2k = 1 << 30
+    # x2k steps through x^(2^k) for k = 3, 4, ...
+    for _ in range(3):
+        x2k = _multmodp(x2k, x2k)
+    while n:
+        if n & 1:
+            p = _multmodp(x2k, p)
+        n >>= 1
+        x2k = _multmodp(x2k, x2k)
+    return p
+
+
+def crc32_combine(crc1, crc2, len2):
+    """Computes the CRC of two pieces of data from each of their CRCs."""
+    return _multmodp(_x8nmodp(len2), crc1) ^ crc2
+
+
+def _crc32_numpy(data, value):
+    """Computes a CRC by splitting the data into lanes that NumPy runs together.
+
+    Each lane is an equal-length slice of the data. Their CRCs are computed side
+    by side, a byte from every lane at a time, and then combined. The number of
+    lanes balances the per-byte NumPy overhead against the cost of combining."""
+    arr = np.frombuffer(data, dtype=np.uint8)
+    num_lanes = max(1, math.isqrt(len(arr) // 2))
+    lane_len = len(arr) // num_lanes
+    # Transposed, so that the bytes at each offset into the lanes are contiguous.
+    lanes = arr[: num_lanes * lane_len].reshape(num_lanes, lane_len).T.copy()
+    table = np.array(tables[0], dtype=np.uint32)
+    crcs = np.full(num_lanes, 0xFFFFFFFF, dtype=np.uint32)
+    for column in lanes:
+        crcs = table[(crcs ^ column) & 0xFF] ^ (crcs >> 8)
+    crcs ^= 0xFFFFFFFF
+    shift = _x8nmodp(lane_len)
+    crc = value
+    for lane_crc in crcs.tolist():
+        crc = _multmodp(shift, crc) ^ lane_crc
+    rest = data[num_lanes * lane_len :]
+    return _crc32_sliced(rest, crc ^ 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+
+def crc32(data, value=0):
+    """Computes the CRC-32 of some data.
+
+    To compute the CRC of data that comes in pieces, pass the CRC of everything
+    before it as value."""
+    data = memoryview(data).cast("B")
+    if np is not None and len(data) >= VECTORIZE_MIN:
+        return _crc32_numpy(data, value)
+    return _crc32_sliced(data, value ^ 0xFFFFFFFF) ^ 0xFFFFFFFF
+
+
+def main():
+    import os
+    import zlib
+
+    print("Test CRC-32 against zlib:")
+    data = os.urandom(5 * VECTORIZE_MIN + 12345)
+    for size in [0, 1, 7, 8, 9, 1000, VECTORIZE_MIN, len(data)]:
+        assert crc32(data[:size]) == zlib.crc32(data[:size]), size
+
+    print("Test incremental CRC-32:")
+    value = crc32(b"")
+    for start in range(0, len(data), 77777):
+        value = crc32(data[start : start + 77777], value)
+    assert value == zlib.crc32(data)
+    print(hex(value))
+
+    print("Test combining CRC-32s:")
+    a, b = data[:1234], data[1234:]
+    assert crc32_combine(crc32(a), crc32(b), len(b)) == zlib.crc32(data)
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -4,11 +4,20 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 from collections import namedtuple
-from huffman import HuffmanTree, CodeSpec
-import copy
-from bitwriter import BitWriter
+from enum import IntEnum
+
 from bitreader import BitReader
-from lz77 import LzIoInterface
+from bitwriter import BitWriter
+from huffman import CodeSpec, HuffmanCode, HuffmanTable, code_lengths, reverse_bits
+from lz77 import MAX_MATCH, LzIoInterface
+
+
+class BlockType(IntEnum):
+    NONE = 0b00
+    HUFFMAN_FIXED = 0b01
+    HUFFMAN_DYNAMIC = 0b10
+    RESERVED = 0b11
+
 
 LengthSymbolInfo = namedtuple("LengthSymbolInfo", ["num_extra_bits", "base"])
 """Associates information with a length/distance symbol.
@@ -87,35 +96,98 @@ length_alphabet = [
 distance_alphabet = [
     CodeSpec(0, 5, range(0b0_0000, 0b1_1111 + 1)),
 ]
+END_OF_BLOCK = 0x100
+NUM_LITERALLENGTH_SYMBOLS = 286
+"""Number of literal/length symbols that may actually occur in a block."""
+NUM_DISTANCE_SYMBOLS = 30
+"""Number of distance symbols that may actually occur in a block."""
+MAX_BITS = 15
+"""Longest code allowed in the literal/length and distance alphabets."""
+MAX_CL_BITS = 7
+"""Longest code allowed in the code length alphabet."""
+CODE_LENGTH_ORDER = (16, 17, 18, 0, 8, 7, 9, 6, 10, 5, 11, 4, 12, 3, 13, 2, 14, 1, 15)
+"""Order that the code lengths for the code length alphabet are written in.
+
+Lengths that are rarely used come last, so that they can be left off."""
+CL_EXTRA_BITS = {16: 2, 17: 3, 18: 7}
+"""Number of extra bits following each of the code length repeat symbols."""
+
 length_alphabet_info = _make_lai()
 distance_alphabet_info = _make_dai()
 
-base_llht = HuffmanTree()
-base_llht.add_alphabet(length_alphabet)
-fixed_llht = copy.deepcopy(base_llht)
-fixed_llht.add_alphabet(fixed_alphabet)
-fixed_dht = HuffmanTree()
-fixed_dht.add_alphabet(distance_alphabet)
 
+def _alphabet_lengths(*alphabets):
+    """Lists the code length of each symbol in some alphabets of CodeSpecs."""
+    lengths = {}
+    for alphabet in alphabets:
+        for code_group in alphabet:
+            for i in range(len(code_group.codes)):
+                lengths[code_group.symbol_base + i] = code_group.code_len
+    return [lengths[sym] for sym in range(len(lengths))]
+
+
+# The fixed codes are canonical, so they can be rebuilt from just the lengths.
+fixed_ll_lengths = _alphabet_lengths(fixed_alphabet, length_alphabet)
+fixed_d_lengths = _alphabet_lengths(distance_alphabet)
+fixed_llcode = HuffmanCode(fixed_ll_lengths)
+fixed_dcode = HuffmanCode(fixed_d_lengths)
+fixed_lltable = HuffmanTable(fixed_ll_lengths)
+fixed_dtable = HuffmanTable(fixed_d_lengths)
+
+
+LengthCode = namedtuple("LengthCode", ["symbol", "num_extra_bits", "extra"])
+"""Everything needed to write a length: its symbol, and its extra bits."""
+
+
+def _make_length_codes():
+    """Constructs a table mapping each length to its LengthCode."""
+    length_codes = [None] * (MAX_MATCH + 1)
+    for symbol, info in length_alphabet_info.items():
+        for extra in range(2**info.num_extra_bits):
+            length = info.base + extra
+            # Length 258 could also be written as symbol 284 with all extra bits
+            # set, but 285 comes later and overrides it.
+            if length <= MAX_MATCH:
+                length_codes[length] = LengthCode(symbol, info.num_extra_bits, extra)
+    return length_codes
 
-def _get_symbol_info(num, alphabet):
-    """Retrieves information associated with a length/distance symbol."""
-    # TODO: This could probably be faster.
-    ret = None
-    for cur_sym, cur_info in alphabet.items():
-        if cur_info.base > num:
-            break
-        ret = (cur_sym, cur_info)
-    assert ret is not None, f"symbol {num} not found"
-    return ret
+
+def _distance_index(distance):
+    return distance - 1 if distance <= 256 else 256 + ((distance - 1) >> 7)
+
+
+def _make_distance_codes():
+    """Constructs a table mapping distances to distance symbols.
+
+    This works like zlib's _dist_code. The first 256 entries are for distances of
+    up to 256. Every symbol for a longer distance has at least 7 extra bits, so
+    the rest of the entries are indexed by distance with the lowest 7 bits
+    dropped."""
+    distance_codes = bytearray(512)
+    for symbol, info in distance_alphabet_info.items():
+        for distance in range(info.base, info.base + 2**info.num_extra_bits):
+            distance_codes[_distance_index(distance)] = symbol
+    return distance_codes
+
+
+length_codes = _make_length_codes()
+distance_codes = _make_distance_codes()
+# These are indexed by symbol, with None for symbols that should never appear.
+length_symbol_info = [length_alphabet_info.get(sym) for sym in range(288)]
+distance_symbol_info = [distance_alphabet_info.get(sym) for sym in range(32)]
+
+
+def distance_symbol(distance):
+    """Looks up the symbol for a distance."""
+    return distance_codes[_distance_index(distance)]
 
 
 # TODO: this is a bad name. it should reflect the fact that it encapsulates IO.
 class Deflate(LzIoInterface):
     def __init__(
         self,
-        literallength_ht: HuffmanTree,
-        distance_ht=HuffmanTree,
+        literallength_ht,
+        distance_ht,
         /,
         bw: BitWriter = None,
         br: BitReader = None,
@@ -125,12 +197,9 @@ class Deflate(LzIoInterface):
         self.bw = bw
         self.br = br
 
-    def _write_symbol(self, symbol, ht):
-        """Writes a symbol from the combined literal/length alphabet."""
-        code, code_len = ht.map[symbol]
-        # Huffman codes in DEFLATE are written MSB first.
-        code_rev = int(f"{code:0{code_len}b}"[::-1], 2)
-        self.bw.write_bits(code_rev, code_len)
+    def _write_symbol(self, symbol, code):
+        """Writes a symbol using a HuffmanCode."""
+        self.bw.write_bits(code.codes[symbol], code.lengths[symbol])
 
     def write_literal(self, literal):
         """Writes a literal from the literal/length alphabet."""
@@ -138,7 +207,34 @@ class Deflate(LzIoInterface):
 
     def write_end(self):
         """Writes an end-of-block code from the literal/length alphabet."""
-        self._write_symbol(0x100, self.literallength_ht)
+        self._write_symbol(END_OF_BLOCK, self.literallength_ht)
+
+    def read_symbol(self, table):
+        """Reads a symbol using a HuffmanTable."""
+        return table.decode(self.br)
+
+    def read_int(self, num_bits):
+        """Reads a little-endian integer that is not Huffman coded."""
+        return self.br.read_int(num_bits)
+
+    def read_literallength(self):
+        """Reads a symbol from the literal/length alphabet."""
+        return self.read_symbol(self.literallength_ht)
+
+    def read_length(self, lsym):
+        """Reads the extra bits for a length symbol, and returns the length."""
+        lsym_info = length_symbol_info[lsym]
+        if lsym_info is None:
+            raise ValueError(f"invalid length symbol {lsym}")
+        return lsym_info.base + self.read_int(lsym_info.num_extra_bits)
+
+    def read_distance(self):
+        """Reads a distance symbol and its extra bits, and returns the distance."""
+        dsym = self.read_symbol(self.distance_ht)
+        dsym_info = distance_symbol_info[dsym]
+        if dsym_info is None:
+            raise ValueError(f"invalid distance symbol {dsym}")
+        return dsym_info.base + self.read_int(dsym_info.num_extra_bits)
 
     def write_backref(self, distance, length):
         """Writes a back-reference.
@@ -148,15 +244,186 @@ class Deflate(LzIoInterface):
         - Any extra bits for the length.
         - A distance symbol from the distance alphabet.
         - Any extra bits for the distance."""
-        (lsym, lsym_info) = _get_symbol_info(length, length_alphabet_info)
+        lsym, lnum_extra_bits, lextra = length_codes[length]
         self._write_symbol(lsym, self.literallength_ht)
-        self.bw.write_bits(length - lsym_info.base, lsym_info.num_extra_bits)
-        (dsym, dsym_info) = _get_symbol_info(distance, distance_alphabet_info)
+        if lnum_extra_bits:
+            self.bw.write_bits(lextra, lnum_extra_bits)
+        if distance <= 256:
+            dsym = distance_codes[distance - 1]
+        else:
+            dsym = distance_codes[256 + ((distance - 1) >> 7)]
         # Even though this can be a fixed-length code, it still is a Huffman code
         # and it still gets written MSB first.
         self._write_symbol(dsym, self.distance_ht)
-        # TODO: skip this function call if the number of bits is zero
-        self.bw.write_bits(distance - dsym_info.base, dsym_info.num_extra_bits)
+        dsym_info = distance_symbol_info[dsym]
+        if dsym_info.num_extra_bits:
+            self.bw.write_bits(distance - dsym_info.base, dsym_info.num_extra_bits)
+
+
+def _rle_code_lengths(lengths):
+    """Run-length encodes code lengths using the code length alphabet.
+
+    Returns a list of (symbol, extra) tuples, where extra is the value of the
+    extra bits following the symbol (if any)."""
+    out = []
+    i = 0
+    while i < len(lengths):
+        cur = lengths[i]
+        run = 1
+        while i + run < len(lengths) and lengths[i + run] == cur:
+            run += 1
+        i += run
+        if cur == 0:
+            while run >= 11:
+                rep = min(run, 138)
+                out.append((18, rep - 11))
+                run -= rep
+            if run >= 3:
+                out.append((17, run - 3))
+                run = 0
+        else:
+            # Symbol 16 repeats the previous length, so the length itself has to
+            # be written once first.
+            out.append((cur, 0))
+            run -= 1
+            while run >= 3:
+                rep = min(run, 6)
+                out.append((16, rep - 3))
+                run -= rep
+        out.extend([(cur, 0)] * run)
+    return out
+
+
+def _cost(frequencies, lengths):
+    """Computes the number of bits needed to write some symbols."""
+    return sum(freq * code_len for freq, code_len in zip(frequencies, lengths))
+
+
+DynamicHeader = namedtuple(
+    "DynamicHeader", ["hlit", "hdist", "hclen", "cl_lengths", "cl_symbols", "cost"]
+)
+"""Everything needed to write the header of a dynamic Huffman block.
+
+hlit, hdist and hclen are the numbers of literal/length, distance, and code
+length code lengths (not yet offset for writing). cl_symbols is the run-length
+encoded literal/length and distance code lengths. cost is the size of the
+header in bits."""
+
+
+def _make_dynamic_header(ll_lengths, d_lengths):
+    """Works out the header of a dynamic block with the given code lengths."""
+    hlit = len(ll_lengths)
+    while hlit > END_OF_BLOCK + 1 and ll_lengths[hlit - 1] == 0:
+        hlit -= 1
+    hdist = len(d_lengths)
+    while hdist > 1 and d_lengths[hdist - 1] == 0:
+        hdist -= 1
+    # The two sets of lengths are run-length encoded as one, so a run is allowed
+    # to continue from one into the other.
+    cl_symbols = _rle_code_lengths(ll_lengths[:hlit] + d_lengths[:hdist])
+    cl_freq = [0] * len(CODE_LENGTH_ORDER)
+    for sym, _ in cl_symbols:
+        cl_freq[sym] += 1
+    cl_lengths = code_lengths(cl_freq, MAX_CL_BITS)
+    hclen = len(CODE_LENGTH_ORDER)
+    while hclen > 4 and cl_lengths[CODE_LENGTH_ORDER[hclen - 1]] == 0:
+        hclen -= 1
+    extra = sum(cl_freq[sym] * eb for sym, eb in CL_EXTRA_BITS.items())
+    cost = 5 + 5 + 4 + 3 * hclen + _cost(cl_freq, cl_lengths) + extra
+    return DynamicHeader(hlit, hdist, hclen, cl_lengths, cl_symbols, cost)
+
+
+class BlockWriter(LzIoInterface):
+    """Writes LZ77 output as blocks, using whichever Huffman codes suit each best.
+
+    The symbol frequencies have to be known before dynamic Huffman codes can be
+    built, so the output is buffered until a block is full (or finish is called),
+    at which point the block is written with either the fixed codes or its own
+    dynamic codes, whichever comes out smaller."""
+
+    BLOCK_SIZE = 2**14
+    """Number of literals and back-references to buffer for each block."""
+
+    def __init__(self, bw: BitWriter, block_size=BLOCK_SIZE):
+        self.bw = bw
+        self.block_size = block_size
+        self._reset()
+
+    def _reset(self):
+        self.tokens = []
+        """Buffered literals (as ints) and back-references (as tuples)."""
+        self.ll_freq = [0] * NUM_LITERALLENGTH_SYMBOLS
+        self.d_freq = [0] * NUM_DISTANCE_SYMBOLS
+
+    def write_literal(self, literal):
+        self.tokens.append(literal)
+        self.ll_freq[literal] += 1
+        if len(self.tokens) >= self.block_size:
+            self._write_block(False)
+
+    def write_backref(self, distance, length):
+        self.tokens.append((distance, length))
+        self.ll_freq[length_codes[length].symbol] += 1
+        self.d_freq[distance_symbol(distance)] += 1
+        if len(self.tokens) >= self.block_size:
+            self._write_block(False)
+
+    def flush(self):
+        """Writes out everything that has been buffered, if anything."""
+        if self.tokens:
+            self._write_block(False)
+
+    def finish(self):
+        """Writes out everything that has been buffered as the final block."""
+        self._write_block(True)
+
+    def _write_dynamic_header(self, header):
+        """Writes the code lengths that describe a block's dynamic Huffman codes."""
+        self.bw.write_bits(header.hlit - 257, 5)
+        self.bw.write_bits(header.hdist - 1, 5)
+        self.bw.write_bits(header.hclen - 4, 4)
+        for sym in CODE_LENGTH_ORDER[: header.hclen]:
+            self.bw.write_bits(header.cl_lengths[sym], 3)
+        deflate_cl = Deflate(HuffmanCode(header.cl_lengths), None, self.bw)
+        for sym, extra in header.cl_symbols:
+            deflate_cl.write_literal(sym)
+            if sym in CL_EXTRA_BITS:
+                self.bw.write_bits(extra, CL_EXTRA_BITS[sym])
+
+    def _write_block(self, bfinal):
+        self.ll_freq[END_OF_BLOCK] += 1
+        ll_lengths = code_lengths(self.ll_freq, MAX_BITS)
+        d_lengths = code_lengths(self.d_freq, MAX_BITS)
+        # The extra bits are the same either way, so we can leave them out.
+        fixed_cost = _cost(self.ll_freq, fixed_ll_lengths) + _cost(
+            self.d_freq, fixed_d_lengths
+        )
+        header = _make_dynamic_header(ll_lengths, d_lengths)
+        dynamic_cost = (
+            header.cost
+            + _cost(self.ll_freq, ll_lengths)
+            + _cost(self.d_freq, d_lengths)
+        )
+
+        self.bw.write_bits(bfinal, 1)
+        if fixed_cost <= dynamic_cost:
+            self.bw.write_bits(BlockType.HUFFMAN_FIXED, 2)
+            deflate_ = Deflate(fixed_llcode, fixed_dcode, self.bw)
+        else:
+            self.bw.write_bits(BlockType.HUFFMAN_DYNAMIC, 2)
+            self._write_dynamic_header(header)
+            deflate_ = Deflate(
+                HuffmanCode(ll_lengths),
+                HuffmanCode(d_lengths),
+                self.bw,
+            )
+        for token in self.tokens:
+            if type(token) is int:
+                deflate_.write_literal(token)
+            else:
+                deflate_.write_backref(*token)
+        deflate_.write_end()
+        self._reset()
 
 
 def main():
@@ -164,10 +431,24 @@ def main():
     # print(f"{distance_alphabet_info=}")
     # print(f"{base_ht=}")
     # print(f"{fixed_ht=}")
-    print(_get_symbol_info(199, length_alphabet_info))
-    print(_get_symbol_info(1, distance_alphabet_info))
-    print(_get_symbol_info(3, length_alphabet_info))
-    print(_get_symbol_info(14200, distance_alphabet_info))
+    print(length_codes[199])
+    print(distance_symbol(1))
+    print(length_codes[3])
+    print(distance_symbol(14200))
+    for length in range(3, MAX_MATCH + 1):
+        lsym, _, extra = length_codes[length]
+        assert length_symbol_info[lsym].base + extra == length
+    for distance in range(1, 2**15 + 1):
+        dsym_info = distance_symbol_info[distance_symbol(distance)]
+        assert dsym_info.base <= distance < dsym_info.base + 2**dsym_info.num_extra_bits
+    for alphabet, code in [
+        (fixed_alphabet + length_alphabet, fixed_llcode),
+        (distance_alphabet, fixed_dcode),
+    ]:
+        for code_group in alphabet:
+            for i, expected in enumerate(code_group.codes):
+                actual = code.codes[code_group.symbol_base + i]
+                assert actual == reverse_bits(expected, code_group.code_len)
 
 
 if __name__ == "__main__":
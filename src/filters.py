@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Lucy Loerker, Maxwell Parker-Blue
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from enum import Enum, IntEnum
+from itertools import accumulate
+
+import zlib_
+
+# PNG filtering is defined in: https://www.w3.org/TR/png/#9Filters
+#
+# Filters predict each byte from the byte one pixel to its left (a), the byte
+# above it (b), and the byte above and to the left (c), and store the difference.
+# Rather than looping over the bytes of a row in Python, each row is spread out
+# into a big integer with one 16-bit lane per byte. A lane has enough headroom
+# that sums and biased differences never carry into the next, so big integer
+# arithmetic does the same thing to every byte of the row at once.
+#
+# Unfiltering Sub, Average and Paeth depends on the bytes just reconstructed, so
+# those can't be done all at once in the same way.
+
+
+class FilterType(IntEnum):
+    NONE = 0
+    SUB = 1
+    UP = 2
+    AVERAGE = 3
+    PAETH = 4
+
+
+class Heuristic(Enum):
+    FIXED = 0
+    """Use the same filter type for every row."""
+    MIN_SUM = 1
+    """Use the filter that minimizes the sum of the absolute (signed) differences.
+
+    This is the heuristic recommended by the spec, and the one libpng uses."""
+    BRUTE_FORCE = 2
+    """Try compressing the row with every filter, and use whichever is smallest.
+
+    This is much slower, and usually only slightly better than MIN_SUM."""
+
+
+LANE_BITS = 16
+BIAS_BIT = 14
+"""Bit set in every lane before subtracting, so that a lane never borrows."""
+
+_abs_table = bytes(min(n, 256 - n) for n in range(256))
+"""Maps a byte to the magnitude of it as a signed difference."""
+
+
+class _Lanes:
+    """Constants for doing lane-wise arithmetic on rows of a given length."""
+
+    def __init__(self, length):
+        self.length = length
+        one = int.from_bytes(b"\x01\x00" * length, "little")
+        self.ones = one
+        self.all = one * 0xFFFF
+        self.bytes = one * 0xFF
+        self.bias = one << BIAS_BIT
+
+    def widen(self, row):
+        wide = bytearray(2 * self.length)
+        wide[::2] = row
+        return int.from_bytes(wide, "little")
+
+    def narrow(self, x):
+        return x.to_bytes(2 * self.length, "little")[::2]
+
+    def shift(self, x, bpp):
+        """Moves every lane bpp lanes to the right, so each lane sees its left."""
+        return (x << LANE_BITS * bpp) & self.all
+
+    def le(self, x, y):
+        """Mask of the lanes where x <= y."""
+        flags = ((y | self.bias) - x) >> BIAS_BIT & self.ones
+        return flags * 0xFFFF
+
+    def abs_diff(self, x, y):
+        ge = self.le(y, x)
+        diff = (((x | self.bias) - y) & ge) | (((y | self.bias) - x) & ~ge & self.all)
+        return diff - self.bias
+
+    def sub(self, x, pred):
+        """Lane-wise (x - pred) modulo 256."""
+        return ((x | 0x100 * self.ones) - pred) & self.bytes
+
+
+def _predict(lanes, filter_type, a, b, c):
+    match filter_type:
+        case FilterType.SUB:
+            return a
+        case FilterType.UP:
+            return b
+        case FilterType.AVERAGE:
+            return (a + b) >> 1 & lanes.bytes
+        case FilterType.PAETH:
+            # p = a + b - c, and the predictor is whichever of a, b or c is
+            # closest to p, preferring them in that order.
+            pa = lanes.abs_diff(b, c)
+            pb = lanes.abs_diff(a, c)
+            pc = lanes.abs_diff(a + b, c << 1)
+            use_a = lanes.le(pa, pb) & lanes.le(pa, pc)
+            use_b = ~use_a & lanes.le(pb, pc)
+            use_c = ~(use_a | use_b)
+            return (a & use_a) | (b & use_b) | (c & use_c)
+
+
+def filter_row(filter_type, row, prior, bpp, lanes=None):
+    """Filters one row, given the (unfiltered) row before it.
+
+    bpp is the number of bytes per complete pixel, rounded up to at least 1.
+    prior should be all zeroes for the first row. Returns the filtered bytes,
+    without the leading filter type byte."""
+    if filter_type == FilterType.NONE:
+        return bytes(row)
+    if lanes is None:
+        lanes = _Lanes(len(row))
+    x = lanes.widen(row)
+    b = lanes.widen(prior)
+    a = lanes.shift(x, bpp)
+    c = lanes.shift(b, bpp)
+    return lanes.narrow(lanes.sub(x, _predict(lanes, filter_type, a, b, c)))
+
+
+def _trial_size(data):
+    compressor = zlib_.Compressor(1)
+    return len(compressor.compress(data)) + len(compressor.flush())
+
+
+def iter_filtered(rows, bpp, heuristic=Heuristic.MIN_SUM, filter_type=FilterType.NONE):
+    """Filters rows of unfiltered bytes as they come.
+
+    filter_type is used for every row if the heuristic is FIXED. Yields each
+    filtered row, preceded by its filter type byte."""
+    prior = None
+    prev_filtered = b""
+    for row in rows:
+        if prior is None:
+            prior = bytes(len(row))
+            lanes = _Lanes(len(row))
+        if heuristic == Heuristic.FIXED:
+            best_type = filter_type
+            best = filter_row(filter_type, row, prior, bpp, lanes)
+        else:
+            best_cost = None
+            for cur_type in FilterType:
+                filtered = filter_row(cur_type, row, prior, bpp, lanes)
+                if heuristic == Heuristic.MIN_SUM:
+                    cost = sum(filtered.translate(_abs_table))
+                else:
+                    # Compress it after the previous row, so that matches
+                    # against that row count in its favour.
+                    cost = _trial_size(prev_filtered + filtered)
+                if best_cost is None or cost < best_cost:
+                    best_type = cur_type
+                    best = filtered
+                    best_cost = cost
+        yield bytes((best_type,)) + best
+        prior = row
+        prev_filtered = best
+
+
+def filter_rows(rows, bpp, heuristic=Heuristic.MIN_SUM, filter_type=FilterType.NONE):
+    """Filters a whole image, given its rows of unfiltered bytes.
+
+    Returns the filtered data, with each row preceded by its filter type byte."""
+    return b"".join(iter_filtered(rows, bpp, heuristic, filter_type))
+
+
+_to_byte = (0xFF).__and__
+
+
+def unfilter_row(filter_type, line, prior, bpp, lanes=None):
+    """Reconstructs one row, given the (reconstructed) row before it."""
+    match filter_type:
+        case FilterType.NONE:
+            return bytes(line)
+        case FilterType.SUB:
+            # Each byte is a running sum of every bpp-th byte before it.
+            out = bytearray(line)
+            for i in range(bpp):
+                out[i::bpp] = bytes(map(_to_byte, accumulate(line[i::bpp])))
+            return bytes(out)
+        case FilterType.UP:
+            if lanes is None:
+                lanes = _Lanes(len(line))
+            return lanes.narrow(lanes.widen(line) + lanes.widen(prior) & lanes.bytes)
+        case FilterType.AVERAGE:
+            out = bytearray(line)
+            for i in range(min(bpp, len(out))):
+                out[i] = (out[i] + (prior[i] >> 1)) & 0xFF
+            for i in range(bpp, len(out)):
+                out[i] = (out[i] + ((out[i - bpp] + prior[i]) >> 1)) & 0xFF
+            return bytes(out)
+        case FilterType.PAETH:
+            out = bytearray(line)
+            for i in range(min(bpp, len(out))):
+                out[i] = (out[i] + prior[i]) & 0xFF
+            for i in range(bpp, len(out)):
+                a = out[i - bpp]
+                b = prior[i]
+                c = prior[i - bpp]
+                pa = abs(b - c)
+                pb = abs(a - c)
+                pc = abs(a + b - c - c)
+                if pa <= pb and pa <= pc:
+                    out[i] = (out[i] + a) & 0xFF
+                elif pb <= pc:
+                    out[i] = (out[i] + b) & 0xFF
+                else:
+                    out[i] = (out[i] + c) & 0xFF
+            return bytes(out)
+    raise ValueError(f"invalid filter type {filter_type}")
+
+
+def unfilter_rows(data, row_size, height, bpp):
+    """Reconstructs the rows of an image from its filtered data.
+
+    row_size is the number of bytes in a row, not counting the filter type byte.
+    Returns a list of the rows."""
+    if len(data) < (row_size + 1) * height:
+        raise ValueError("image data is truncated")
+    data = memoryview(data)
+    lanes = _Lanes(row_size)
+    prior = bytes(row_size)
+    rows = []
+    for y in range(height):
+        start = y * (row_size + 1)
+        line = data[start + 1 : start + 1 + row_size]
+        prior = unfilter_row(data[start], line, prior, bpp, lanes)
+        rows.append(prior)
+    return rows
+
+
+def _paeth_predictor(a, b, c):
+    """Straight from the spec, to test the vectorized version against."""
+    p = a + b - c
+    pa = abs(p - a)
+    pb = abs(p - b)
+    pc = abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    elif pb <= pc:
+        return b
+    return c
+
+
+def _filter_row_slow(filter_type, row, prior, bpp):
+    out = bytearray()
+    for i, x in enumerate(row):
+        a = row[i - bpp] if i >= bpp else 0
+        b = prior[i]
+        c = prior[i - bpp] if i >= bpp else 0
+        match filter_type:
+            case FilterType.NONE:
+                pred = 0
+            case FilterType.SUB:
+                pred = a
+            case FilterType.UP:
+                pred = b
+            case FilterType.AVERAGE:
+                pred = (a + b) // 2
+            case FilterType.PAETH:
+                pred = _paeth_predictor(a, b, c)
+        out.append((x - pred) % 256)
+    return bytes(out)
+
+
+def main():
+    import random
+
+    print("Test filters against the spec:")
+    rng = random.Random(0)
+    for bpp in [1, 3, 4]:
+        for _ in range(20):
+            length = bpp * rng.randrange(1, 40)
+            row = bytes(
+                rng.choice([0, 1, 127, 128, 254, 255, rng.randrange(256)])
+                for _ in range(length)
+            )
+            prior = bytes(rng.randrange(256) for _ in range(length))
+            for filter_type in FilterType:
+                assert filter_row(filter_type, row, prior, bpp) == _filter_row_slow(
+                    filter_type, row, prior, bpp
+                ), (filter_type, bpp)
+                filtered = filter_row(filter_type, row, prior, bpp)
+                assert unfilter_row(filter_type, filtered, prior, bpp) == row
+
+    print("Test filter selection:")
+    rows = [bytes((x + y) % 256 for x in range(30)) for y in range(10)]
+    for heuristic in Heuristic:
+        data = filter_rows(rows, 3, heuristic)
+        assert len(data) == 10 * 31
+        print(heuristic.name, list(data[::31]))
+        assert unfilter_rows(data, 30, 10, 3) == rows
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -58,6 +58,12 @@ class Display(ttk.Frame):
         Label(text=f"imporant colors = {file.dib.important_colors}").grid(
             row=12, column=0, padx=10, pady=3, sticky="w"
         )
+        if file.header.valid:
+            # Tk can't read BMPs itself, but it can read the PPM we make from them.
+            self.preview = tkinter.PhotoImage(data=file.pixels.to_ppm(), format="PPM")
+            Label(image=self.preview).grid(
+                row=13, column=0, padx=10, pady=3, sticky="w"
+            )
 
 
 class StartPage(ttk.Frame):
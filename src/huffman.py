@@ -3,9 +3,11 @@
 # Copyright 2023 Lucy Loerker, Maxwell Parker-Blue
 # SPDX-License-Identifier: GPL-2.0-or-later
 
-from collections import namedtuple
+import heapq
 import math
 from abc import ABC, abstractmethod
+from array import array
+from collections import namedtuple
 
 CodeSpec = namedtuple("CodeSpec", ["symbol_base", "code_len", "codes"])
 """Specification of one or more codes with contiguous symbols.
@@ -99,6 +101,106 @@ class HuffmanTree:
         return str(self.__dict__)
 
 
+def reverse_bits(code, code_len):
+    """Reverses the order of the lowest code_len bits of code."""
+    return int(f"{code:0{code_len}b}"[::-1], 2) if code_len else 0
+
+
+class HuffmanCode:
+    """Canonical Huffman code, laid out for encoding.
+
+    codes and lengths are flat arrays indexed by symbol. The codes are stored
+    bit-reversed, since DEFLATE writes Huffman codes MSB first but packs bits LSB
+    first, so each can be written out as-is.
+    """
+
+    def __init__(self, lengths):
+        self.lengths = array("B", lengths)
+        """Length of each symbol's code, or 0 if the symbol has no code."""
+        self.codes = array(
+            "H",
+            (
+                reverse_bits(code, code_len)
+                for code, code_len in zip(canonical_codes(lengths), lengths)
+            ),
+        )
+        """Bit-reversed code for each symbol."""
+
+
+class HuffmanTable:
+    """Lookup table for decoding canonical Huffman codes.
+
+    Rather than following a code one bit at a time, the next primary_bits bits of
+    input are used as an index into the primary table. Codes that are longer
+    than that spill over into sub-tables, which are indexed by the remaining
+    bits, so that decoding any symbol takes one or two lookups.
+
+    Since codes are read MSB first, but bits are peeked LSB first, the tables are
+    indexed by bit-reversed codes.
+    """
+
+    SUBTABLE = 0b1_0000
+    """Flag marking an entry as pointing to a sub-table."""
+    PRIMARY_BITS = 9
+
+    def __init__(self, lengths, primary_bits=PRIMARY_BITS):
+        self.max_len = max(lengths, default=0)
+        self.primary_bits = max(1, min(primary_bits, self.max_len))
+        primary_size = 2**self.primary_bits
+        self.table = [0] * primary_size
+        """Primary table, followed by any sub-tables.
+
+        A symbol's entry is (symbol << 5 | code_len). A sub-table's entry in the
+        primary table is (offset << 5 | SUBTABLE | subtable_bits), where offset
+        is where the sub-table starts. An entry of 0 means that there is no such
+        code."""
+
+        codes = canonical_codes(lengths)
+        long_codes = {}
+        """Codes that do not fit in the primary table, keyed by their prefix."""
+        for symbol, (code, code_len) in enumerate(zip(codes, lengths)):
+            if code_len == 0:
+                continue
+            rev = reverse_bits(code, code_len)
+            if code_len <= self.primary_bits:
+                # Every index that starts with this code decodes to it.
+                entry = symbol << 5 | code_len
+                for index in range(rev, primary_size, 2**code_len):
+                    self.table[index] = entry
+            else:
+                prefix = rev & (primary_size - 1)
+                long_codes.setdefault(prefix, []).append((symbol, rev, code_len))
+
+        for prefix, group in long_codes.items():
+            subtable_bits = max(code_len for _, _, code_len in group)
+            subtable_bits -= self.primary_bits
+            offset = len(self.table)
+            self.table[prefix] = offset << 5 | self.SUBTABLE | subtable_bits
+            self.table += [0] * 2**subtable_bits
+            for symbol, rev, code_len in group:
+                entry = symbol << 5 | code_len
+                suffix_len = code_len - self.primary_bits
+                for index in range(
+                    rev >> self.primary_bits, 2**subtable_bits, 2**suffix_len
+                ):
+                    self.table[offset + index] = entry
+
+    def decode(self, br):
+        """Reads a symbol from a BitReader."""
+        bits = br.peek(self.max_len)
+        entry = self.table[bits & ((1 << self.primary_bits) - 1)]
+        if entry & self.SUBTABLE:
+            subtable_mask = (1 << (entry & 0b1111)) - 1
+            entry = self.table[
+                (entry >> 5) + (bits >> self.primary_bits & subtable_mask)
+            ]
+        code_len = entry & 0b1111
+        if code_len == 0:
+            raise ValueError("invalid Huffman code")
+        br.consume(code_len)
+        return entry >> 5
+
+
 Coin = namedtuple("Coin", ["denomination", "numismatic_value"])
 
 
@@ -140,6 +242,82 @@ def binary_package_merge(largest_denomination, limit, coins):
     return denom_dict
 
 
+def code_lengths(frequencies, max_len):
+    """Computes optimal code lengths that are no longer than max_len.
+
+    frequencies is indexed by symbol, and the returned list of lengths is too.
+    Symbols that never occur are given a length of 0. This uses the
+    Package-merge algorithm, which (unlike building a Huffman tree and then
+    patching it up) is optimal under the length limit.
+
+    A code always has at least two symbols, so that every symbol gets at least
+    one bit. If fewer than two symbols occur, the lowest unused symbols are
+    added with a length of 1.
+    """
+    lengths = [0] * len(frequencies)
+    leaves = sorted(
+        (freq, symbol) for symbol, freq in enumerate(frequencies) if freq > 0
+    )
+    if len(leaves) < 2:
+        used = {symbol for _, symbol in leaves}
+        for symbol in range(len(frequencies)):
+            if len(used) == 2:
+                break
+            used.add(symbol)
+        for symbol in used:
+            lengths[symbol] = 1
+        return lengths
+    assert 2**max_len >= len(leaves), "too many symbols for length limit"
+
+    # Each item is a (weight, node) tuple, where a node is either a leaf symbol,
+    # or a pair of nodes that have been packaged together.
+    items = leaves
+    for _ in range(max_len - 1):
+        packages = [
+            (items[i][0] + items[i + 1][0], (items[i][1], items[i + 1][1]))
+            for i in range(0, len(items) - 1, 2)
+        ]
+        items = list(heapq.merge(leaves, packages, key=lambda item: item[0]))
+    # A symbol's code length is the number of times that its leaf appears among
+    # the cheapest 2n - 2 items.
+    stack = [node for _, node in items[: 2 * len(leaves) - 2]]
+    while stack:
+        node = stack.pop()
+        if type(node) is int:
+            lengths[node] += 1
+        else:
+            stack.extend(node)
+    return lengths
+
+
+def canonical_codes(lengths):
+    """Assigns the canonical Huffman code for some code lengths.
+
+    See section 3.2.2 of RFC 1951. Returns a list of codes indexed by symbol.
+    Symbols with a length of 0 are given a code of 0, which should be ignored.
+    Raises ValueError if there are too many codes of some length for them all to
+    be distinct.
+    """
+    max_len = max(lengths, default=0)
+    bl_count = [0] * (max_len + 1)
+    for code_len in lengths:
+        bl_count[code_len] += 1
+    bl_count[0] = 0
+    next_code = [0] * (max_len + 1)
+    code = 0
+    for bits in range(1, max_len + 1):
+        code = (code + bl_count[bits - 1]) << 1
+        next_code[bits] = code
+        if code + bl_count[bits] > 2**bits:
+            raise ValueError("over-subscribed code lengths")
+    codes = [0] * len(lengths)
+    for symbol, code_len in enumerate(lengths):
+        if code_len:
+            codes[symbol] = next_code[code_len]
+            next_code[code_len] += 1
+    return codes
+
+
 def test_deflate(dump_dot=False):
     deflate_ht = HuffmanTree()
     fixed_alphabet = [
@@ -181,6 +359,22 @@ def main():
     ht.add_code(0b000, 3, "a")
     print(ht)
 
+    print("Test code lengths:")
+    lengths = code_lengths([10, 1, 1, 0, 5, 3], 3)
+    print(lengths)
+    assert lengths == [1, 3, 3, 0, 3, 3]
+    assert canonical_codes(lengths) == [0b0, 0b100, 0b101, 0, 0b110, 0b111]
+
+    print("Test Huffman table:")
+    from bitreader import BitReader
+
+    table = HuffmanTable(lengths, primary_bits=2)
+    # Symbols 0, 4, 1, 0, 5, packed starting from the least significant bit.
+    br = BitReader(bytes((0b0001_0110, 0b0000_0111)))
+    decoded = [table.decode(br) for _ in range(5)]
+    print(decoded)
+    assert decoded == [0, 4, 1, 0, 5]
+
     print("Test Fixed DEFLATE Huffman Tree:")
     test_deflate()
 
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Lucy Loerker, Maxwell Parker-Blue
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import struct
+
+import deflate
+from bitreader import BitReader
+from deflate import BlockType, Deflate
+from huffman import HuffmanTable
+
+# DEFLATE RFC: https://www.rfc-editor.org/rfc/rfc1951
+
+INITIAL_SIZE = 2**16
+"""Size of the output buffer, if we're not given a better guess."""
+DISTANCE_PRIMARY_BITS = 6
+"""Size of the primary table for distance codes, which are typically short."""
+WSIZE = 2**15
+"""Furthest that a back-reference can refer back."""
+
+
+class Inflater:
+    """Decoder for a raw DEFLATE stream.
+
+    Input can be fed in a piece at a time, and decoding picks up where it left
+    off, even in the middle of a block. Each step (a block header, a literal or
+    back-reference, or part of a stored block) is only committed to once all of
+    its input is there; otherwise, the BitReader is rewound to before it, and
+    we wait for more input.
+
+    Output is written into a preallocated buffer which is grown (by doubling) as
+    it fills up, so that we are not reallocating for every literal. Once output
+    has been taken, only the last window of it is kept around.
+    """
+
+    FMT_UNCOMPHEADER = "<HH"
+
+    def __init__(self, dictionary=b"", size_hint=0):
+        self.br = BitReader()
+        self.start = len(dictionary)
+        """Offset of the output that has not been taken yet.
+
+        Anything before this is history, which back-references may refer to but
+        which is not part of the output (for example, the preset dictionary)."""
+        self.out = bytearray(max(self.start + size_hint, INITIAL_SIZE))
+        """Output buffer, of which only the first pos bytes are populated."""
+        self.out[: self.start] = dictionary
+        self.pos = self.start
+        self.block = None
+        """Block that we are in the middle of.
+
+        This is None between blocks, the number of bytes left for a stored block,
+        or a Deflate for a Huffman block."""
+        self.bfinal = False
+        """Whether the current (or last) block is the final one."""
+        self.eof = False
+        """Whether the end of the final block has been reached."""
+
+    def feed(self, data):
+        """Adds more input to be decoded."""
+        self.br.feed(data)
+
+    def take_output(self, max_length=0):
+        """Returns output that has been decoded (up to max_length bytes, if set)."""
+        end = self.pos
+        if max_length:
+            end = min(end, self.start + max_length)
+        data = bytes(self.out[self.start : end])
+        self.start = end
+        # Drop history that can no longer be referred back to, once there is
+        # enough of it to be worth moving everything else.
+        drop = min(self.start, self.pos - WSIZE)
+        if drop >= WSIZE:
+            del self.out[:drop]
+            self.start -= drop
+            self.pos -= drop
+        return data
+
+    def _reserve(self, size):
+        """Makes sure that there is room for size more bytes of output."""
+        needed = self.pos + size - len(self.out)
+        if needed > 0:
+            self.out += bytes(max(needed, len(self.out)))
+
+    def _copy(self, distance, length):
+        """Copies a back-reference to the end of the output."""
+        out = self.out
+        pos = self.pos
+        src = pos - distance
+        if src < 0:
+            raise ValueError("invalid distance too far back")
+        self._reserve(length)
+        if distance >= length:
+            out[pos : pos + length] = out[src : src + length]
+        else:
+            # The back-reference overlaps with itself, so its data repeats every
+            # distance bytes. After copying the first repetition, everything that
+            # we have copied so far can be copied again in one go.
+            out[pos : pos + distance] = out[src:pos]
+            copied = distance
+            while copied < length:
+                size = min(copied, length - copied)
+                out[pos + copied : pos + copied + size] = out[pos : pos + size]
+                copied += size
+        self.pos = pos + length
+
+    def _read_dynamic_header(self, deflate_):
+        """Reads the code lengths for a dynamic block, and builds its tables."""
+        hlit = deflate_.read_int(5) + 257
+        hdist = deflate_.read_int(5) + 1
+        hclen = deflate_.read_int(4) + 4
+        cl_lengths = [0] * len(deflate.CODE_LENGTH_ORDER)
+        for sym in deflate.CODE_LENGTH_ORDER[:hclen]:
+            cl_lengths[sym] = deflate_.read_int(3)
+        cl_table = HuffmanTable(cl_lengths, primary_bits=deflate.MAX_CL_BITS)
+        lengths = []
+        while len(lengths) < hlit + hdist:
+            sym = deflate_.read_symbol(cl_table)
+            if sym < 16:
+                lengths.append(sym)
+                continue
+            extra = deflate_.read_int(deflate.CL_EXTRA_BITS[sym])
+            if sym == 16:
+                if not lengths:
+                    raise ValueError("invalid bit length repeat")
+                lengths += [lengths[-1]] * (3 + extra)
+            elif sym == 17:
+                lengths += [0] * (3 + extra)
+            else:
+                lengths += [0] * (11 + extra)
+        if len(lengths) > hlit + hdist:
+            raise ValueError("invalid bit length repeat")
+        if lengths[deflate.END_OF_BLOCK] == 0:
+            raise ValueError("missing end-of-block code")
+        return (
+            HuffmanTable(lengths[:hlit]),
+            HuffmanTable(lengths[hlit:], primary_bits=DISTANCE_PRIMARY_BITS),
+        )
+
+    def _read_block_header(self):
+        deflate_ = Deflate(None, None, br=self.br)
+        bfinal = deflate_.read_int(1)
+        btype = deflate_.read_int(2)
+        match btype:
+            case BlockType.NONE:
+                size, nsize = struct.unpack(
+                    self.FMT_UNCOMPHEADER, self.br.read_aligned(4)
+                )
+                if size != ~nsize & 0xFFFF:
+                    raise ValueError("invalid stored block lengths")
+                self.block = size
+            case BlockType.HUFFMAN_FIXED:
+                self.block = Deflate(
+                    deflate.fixed_lltable, deflate.fixed_dtable, br=self.br
+                )
+            case BlockType.HUFFMAN_DYNAMIC:
+                lltable, dtable = self._read_dynamic_header(deflate_)
+                self.block = Deflate(lltable, dtable, br=self.br)
+            case _:
+                raise ValueError("invalid block type")
+        self.bfinal = bfinal
+
+    def _inflate_stored(self, max_length):
+        # The header left us byte-aligned, so only whole bytes are left.
+        size = min(self.block, self.br.bits_left() >> 3)
+        if max_length:
+            size = min(size, self.start + max_length - self.pos)
+        data = self.br.read_aligned(size)
+        self._reserve(size)
+        self.out[self.pos : self.pos + size] = data
+        self.pos += size
+        self.block -= size
+        if self.block == 0:
+            self.block = None
+
+    def _inflate_huffman(self, max_length):
+        br = self.br
+        deflate_ = self.block
+        lltable = deflate_.literallength_ht
+        limit = self.start + max_length if max_length else None
+        while limit is None or self.pos < limit:
+            checkpoint = (br.pos, br.bit_buf, br.bit_count)
+            try:
+                sym = lltable.decode(br)
+                if sym < deflate.END_OF_BLOCK:
+                    if self.pos == len(self.out):
+                        self._reserve(1)
+                    self.out[self.pos] = sym
+                    self.pos += 1
+                    continue
+                if sym == deflate.END_OF_BLOCK:
+                    self.block = None
+                    return
+                length = deflate_.read_length(sym)
+                distance = deflate_.read_distance()
+            except EOFError:
+                br.pos, br.bit_buf, br.bit_count = checkpoint
+                return
+            self._copy(distance, length)
+
+    def inflate(self, max_length=0):
+        """Decodes as much of the input as possible.
+
+        Stops at the end of the final block, when the input runs out, or once at
+        least max_length bytes of output are waiting to be taken (if set)."""
+        br = self.br
+        while not self.eof:
+            if max_length and self.pos - self.start >= max_length:
+                return
+            if self.block is None:
+                if self.bfinal:
+                    self.eof = True
+                    return
+                checkpoint = (br.pos, br.bit_buf, br.bit_count)
+                try:
+                    self._read_block_header()
+                except EOFError:
+                    br.pos, br.bit_buf, br.bit_count = checkpoint
+                    return
+                continue
+            if type(self.block) is int:
+                self._inflate_stored(max_length)
+            else:
+                self._inflate_huffman(max_length)
+            if self.block is not None and (
+                not max_length or self.pos - self.start < max_length
+            ):
+                # We stopped partway through a block, and not because of the
+                # output limit, so we must need more input.
+                return
+
+
+def inflate(data, dictionary=b"", size_hint=0):
+    """Decodes a raw DEFLATE stream from a bytes-like object."""
+    inflater = Inflater(dictionary, size_hint)
+    inflater.feed(data)
+    inflater.inflate()
+    if not inflater.eof:
+        raise ValueError("incomplete or truncated stream")
+    return inflater.take_output()
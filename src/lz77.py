@@ -3,9 +3,10 @@
 # Copyright 2023 Lucy Loerker, Maxwell Parker-Blue
 # SPDX-License-Identifier: GPL-2.0-or-later
 
-from collections import defaultdict
-from collections import Counter
 from abc import abstractmethod
+from array import array
+from collections import namedtuple
+from enum import IntEnum
 
 
 class LzIoInterface:
@@ -18,95 +19,695 @@ class LzIoInterface:
         pass
 
 
-# TODO: document these
 MIN_MATCH = 3
+"""Shortest string that is worth encoding as a back-reference."""
 MAX_MATCH = 258
+"""Longest string that a single back-reference can encode."""
 
+HASH_BITS = 15
+HASH_SIZE = 2**HASH_BITS
+HASH_MASK = HASH_SIZE - 1
+HASH_SHIFT = (HASH_BITS + MIN_MATCH - 1) // MIN_MATCH
+"""Amount to shift the running hash by for each byte.
 
-# TODO: make this work using an actual rolling hash
-def _hash_buf(buf, hash_chain):
-    if len(buf < MIN_MATCH):
-        return
-    hash_chain = defaultdict(list)
-    for i in range(0, len(buf), step=MIN_MATCH):
-        current_triplet = buf[i : i + MIN_MATCH]
-        current_hash = hash(current_triplet)
-        # TODO: Is there a better hash function to use, since the length is fixed?
-        # On even a 32-bit system, the 3 bytes should just fit in a regsiter.
-        hash_chain[current_hash].append(i)
-
-
-def string_search(text, pattern):
-    matchidx = None
-    matchlen = 1
-    for i in range(len(text)):
-        num_chars_left = len(text) - i
-        curlen = 0
-        for j in range(min(len(pattern), num_chars_left)):
-            # TODO: special case for repeating past end
-            if text[i + j] != pattern[j]:
-                break
-            curlen += 1
-            if curlen == MAX_MATCH:
+After MIN_MATCH bytes have been shifted in, the oldest one has been shifted out
+entirely, so the hash only ever depends on the last MIN_MATCH bytes."""
+NIL = -1
+"""Chain link meaning that there is no earlier position with the same hash."""
+
+DEFAULT_MAX_CHAIN = 128
+MIN_LOOKAHEAD = MAX_MATCH + MIN_MATCH + 1
+"""Input kept ahead of the next position to encode, until the input is flushed.
+
+With this much, a match is never cut short for want of the rest of the input."""
+TOO_FAR = 4096
+"""Distance past which a match of MIN_MATCH bytes costs more than its literals."""
+
+
+class MatchFinder(IntEnum):
+    HASH_CHAIN = 0
+    """Check the earlier positions with the same hash, closest first."""
+    BINARY_TREE = 1
+    """Keep the earlier positions with each hash in order, which finds longer
+    matches for the same number of candidates checked, but is slower to update."""
+
+
+Config = namedtuple(
+    "Config",
+    [
+        "good_length",
+        "max_lazy",
+        "nice_length",
+        "max_chain",
+        "lazy",
+        "match_finder",
+        "passes",
+    ],
+    defaults=[MatchFinder.HASH_CHAIN, 0],
+)
+"""Tuning for how hard to look for matches, as in zlib's configuration table.
+
+max_chain is the number of candidates checked for each match, cut to a quarter
+if we already have a match of at least good_length. Once a match of nice_length
+is found, we stop looking for a longer one. With lazy matching, we check whether
+the next position has a longer match before taking one, unless it is at least
+max_lazy long. Without it, max_lazy is the longest match whose positions are
+added to the hash chains, since finding them again is rarely worth the time.
+With a binary tree, max_chain is how deep to search it. If passes is set, the
+input is instead parsed optimally, that many times over (see optimal.py)."""
+DEFAULT_CONFIG = Config(8, 16, 128, DEFAULT_MAX_CHAIN, True)
+
+
+class Strategy(IntEnum):
+    DEFAULT = 0
+    FILTERED = 1
+    """Favor literals over short matches, as suits data like filtered images,
+    which is mostly small values with a somewhat random distribution."""
+    HUFFMAN_ONLY = 2
+    """Don't look for matches at all."""
+    RLE = 3
+    """Only look for runs of the same byte, which are matches at distance 1."""
+
+
+def _match_length(buf, a, b, max_len):
+    """Counts how many bytes agree between the strings at a and b.
+
+    Slice comparisons are done in C, so rather than stepping through the strings
+    one byte at a time, we binary search for the first mismatch. The strings are
+    allowed to overlap, which is how a back-reference repeats past its end."""
+    if buf[a : a + max_len] == buf[b : b + max_len]:
+        return max_len
+    # Invariant: the first lo bytes agree, and the first hi bytes do not.
+    lo = 0
+    hi = max_len
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if buf[a + lo : a + mid] == buf[b + lo : b + mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+class HashChain:
+    """Index of where each 3-byte string has previously occurred in a buffer.
+
+    head maps a hash to the most recent position with that hash, and prev maps a
+    position to the previous position with the same hash, so following prev from
+    head visits every candidate match from closest to furthest. Both are flat
+    integer arrays, rather than a dictionary of lists.
+
+    Some data has distances where matches are especially likely, like the row
+    above in an image. If given, those are tried before walking the chain.
+
+    The buffer may grow, up to size bytes if that is given, and may have bytes
+    removed from its start as long as slide() is called to match. The positions
+    held in head and prev count from the start of everything that has been in
+    the buffer, rather than from the start of the buffer, so that sliding only
+    has to drop the start of prev, rather than rewrite every entry.
+    """
+
+    def __init__(self, buf, max_chain=DEFAULT_MAX_CHAIN, probe_distances=(), size=None):
+        self.buf = buf
+        """Buffer being indexed."""
+        self.max_chain = max_chain
+        """Maximum number of candidates to check for each match."""
+        self.probe_distances = sorted(probe_distances)
+        """Distances to try before the chain, closest first."""
+        self.head = array("q", [NIL]) * HASH_SIZE
+        self.prev = array("q", [NIL]) * (len(buf) if size is None else size)
+        self.offset = 0
+        """Number of bytes removed from the start of the buffer so far."""
+        self.ins_h = None
+        """Running hash of the bytes leading up to the next position to insert,
+        or None if it has to be worked out afresh."""
+        self.next_pos = 0
+        """Next position to be inserted into the chains."""
+
+    def insert(self, end):
+        """Inserts every position before end into the chains.
+
+        Positions without MIN_MATCH bytes following them are never inserted,
+        since they cannot start a match."""
+        buf = self.buf
+        head = self.head
+        prev = self.prev
+        start = self.next_pos
+        stop = min(end, len(buf) - MIN_MATCH + 1)
+        if start >= stop:
+            return
+        offset = self.offset
+        h = self.ins_h
+        if h is None:
+            h = (buf[start] << HASH_SHIFT) ^ buf[start + 1]
+        for pos in range(start, stop):
+            h = ((h << HASH_SHIFT) ^ buf[pos + 2]) & HASH_MASK
+            prev[pos] = head[h]
+            head[h] = pos + offset
+        self.ins_h = h
+        self.next_pos = stop
+
+    def skip(self, end):
+        """Moves on to end without inserting the positions before it."""
+        if end > self.next_pos:
+            self.next_pos = end
+            self.ins_h = None
+
+    def slide(self, n):
+        """Catches up with the first n bytes having been removed from the buffer.
+
+        Positions in them are dropped from the chains, and the rest move down."""
+        del self.prev[:n]
+        self.prev += array("q", [NIL]) * n
+        self.offset += n
+        if self.next_pos < n:
+            self.ins_h = None
+        self.next_pos = max(self.next_pos - n, 0)
+
+    def longest_match(
+        self, pos, limit=0, prev_len=0, max_chain=None, nice_length=MAX_MATCH
+    ):
+        """Finds the longest earlier string matching the one at pos.
+
+        The positions before pos must already have been inserted. Candidates
+        before limit are not considered, and neither are matches no longer than
+        prev_len. Returns a (distance, length) tuple, or (0, 0) if there is no
+        match at least MIN_MATCH long."""
+        buf = self.buf
+        prev = self.prev
+        max_len = min(MAX_MATCH, len(buf) - pos)
+        best_len = max(prev_len, MIN_MATCH - 1)
+        if max_len <= best_len:
+            return (0, 0)
+        best_dist = 0
+        chain_left = self.max_chain if max_chain is None else max_chain
+        nice_length = min(nice_length, max_len)
+        for distance in self.probe_distances:
+            cand = pos - distance
+            if cand < limit:
                 break
-        # We want to take the last (= closest) match, so allow equality.
-        if curlen >= matchlen:
-            matchlen = curlen
-            matchidx = i
-    if matchlen < MIN_MATCH:
-        matchidx = None
-    if matchidx == None:
-        matchlen = 0
-    return (matchidx, matchlen)
-
-
-def _process_next_input(
-    lz_io, frequencies, search_buf, lookahead_buf, cur_lookahead_idx
-):
-    if len(lookahead_buf) - cur_lookahead_idx < 3:
-        remaining = lookahead_buf[cur_lookahead_idx:]
-        frequencies.update(remaining)
-        for byte in remaining:
-            lz_io.write_literal(byte)
-    matchidx, matchlen = string_search(search_buf, lookahead_buf[cur_lookahead_idx:])
-    if not matchidx:
-        lz_io.write_literal(lookahead_buf[cur_lookahead_idx])
-        frequencies[lookahead_buf[cur_lookahead_idx]] += 1
-        cur_lookahead_idx += 1
-    else:
-        len_to_search_buf = len(search_buf) - matchidx
-        lz_io.write_backref(len_to_search_buf + cur_lookahead_idx, matchlen)
-        frequencies.update(
-            lookahead_buf[cur_lookahead_idx : cur_lookahead_idx + matchlen]
+            if buf[cand + best_len] == buf[pos + best_len] and buf[cand] == buf[pos]:
+                cur_len = _match_length(buf, cand, pos, max_len)
+                if cur_len >= nice_length:
+                    return (distance, cur_len)
+                if cur_len > best_len:
+                    best_dist = distance
+                    best_len = cur_len
+        if best_dist:
+            # The chain is unlikely to do much better, so don't look as hard.
+            chain_left >>= 1
+        # Both NIL and positions that have been slid out come out negative.
+        offset = self.offset
+        h = (buf[pos] << 2 * HASH_SHIFT) ^ (buf[pos + 1] << HASH_SHIFT) ^ buf[pos + 2]
+        cand = self.head[h & HASH_MASK] - offset
+        while cand >= limit and chain_left > 0:
+            chain_left -= 1
+            # Cheaply rule out candidates that cannot beat what we have, before
+            # doing a full comparison.
+            if buf[cand + best_len] == buf[pos + best_len] and buf[cand] == buf[pos]:
+                cur_len = _match_length(buf, cand, pos, max_len)
+                if cur_len > best_len:
+                    best_dist = pos - cand
+                    best_len = cur_len
+                    if cur_len >= nice_length:
+                        break
+            cand = prev[cand] - offset
+        if best_dist == 0:
+            return (0, 0)
+        return (best_dist, best_len)
+
+
+class BinaryTree:
+    """Index of earlier positions as binary search trees, as in LZMA's bt4.
+
+    Like HashChain, positions are grouped by the hash of the MIN_MATCH bytes
+    at them. Each group is a tree ordered by the strings starting at each
+    position, with newer positions nearer the root. To insert a position, we
+    walk down from the root, passing every string that shares a longer prefix
+    with the new one than any we passed before, so inserting a position also
+    finds all of its matches. The tree is split around the new string along the
+    way, and its halves become the new root's subtrees.
+
+    Nodes are stored in one flat array, with the left and right children of
+    position p at 2 * p and 2 * p + 1. Anything further back than wsize, or
+    deeper than max_depth, is cut off. As in HashChain, the positions held in
+    head and tree count from the start of everything that has been in the buffer.
+    """
+
+    def __init__(self, buf, wsize, max_depth, nice_length=MAX_MATCH, size=None):
+        self.buf = buf
+        """Buffer being indexed."""
+        self.wsize = wsize
+        """Furthest back a match can go."""
+        self.max_depth = max_depth
+        """Maximum number of nodes to visit for each position."""
+        self.nice_length = nice_length
+        """Match length at which to stop looking for a longer one."""
+        self.head = array("q", [NIL]) * HASH_SIZE
+        self.tree = array("q", [NIL]) * (2 * (len(buf) if size is None else size))
+        self.offset = 0
+        """Number of bytes removed from the start of the buffer so far."""
+        self.next_pos = 0
+        """Next position to be inserted into the trees."""
+
+    def _insert(self, pos, max_depth, nice_length, matches=None):
+        """Inserts pos, adding the matches passed on the way to matches.
+
+        Matches come out as (distance, length) tuples, each longer than the
+        last, so each is also the closest one of at least its length."""
+        buf = self.buf
+        tree = self.tree
+        limit = max(pos - self.wsize, 0)
+        max_len = min(MAX_MATCH, len(buf) - pos)
+        nice_length = min(nice_length, max_len)
+        h = (buf[pos] << 2 * HASH_SHIFT) ^ (buf[pos + 1] << HASH_SHIFT) ^ buf[pos + 2]
+        h &= HASH_MASK
+        offset = self.offset
+        cur = self.head[h] - offset
+        self.head[h] = pos + offset
+        # Where to hang the next node found to be before or after pos, and how
+        # long a prefix every node hung there shares with it.
+        lt_slot = 2 * pos
+        gt_slot = 2 * pos + 1
+        lt_len = gt_len = 0
+        best_len = MIN_MATCH - 1
+        while cur >= limit and max_depth > 0:
+            max_depth -= 1
+            # Everything between the nodes hung so far shares at least this
+            # much with pos, so we can start comparing from there.
+            length = min(lt_len, gt_len)
+            if buf[cur + length] == buf[pos + length]:
+                length += _match_length(
+                    buf, cur + length, pos + length, max_len - length
+                )
+                if length > best_len:
+                    best_len = length
+                    if matches is not None:
+                        matches.append((pos - cur, length))
+                if length >= nice_length:
+                    # Take cur's place, since it's no use to us any more.
+                    tree[lt_slot] = tree[2 * cur]
+                    tree[gt_slot] = tree[2 * cur + 1]
+                    return
+            if buf[cur + length] < buf[pos + length]:
+                tree[lt_slot] = cur + offset
+                lt_slot = 2 * cur + 1
+                lt_len = length
+                cur = tree[lt_slot] - offset
+            else:
+                tree[gt_slot] = cur + offset
+                gt_slot = 2 * cur
+                gt_len = length
+                cur = tree[gt_slot] - offset
+        tree[lt_slot] = tree[gt_slot] = NIL
+
+    def insert(self, end):
+        """Inserts every position before end into the trees."""
+        stop = min(end, len(self.buf) - MIN_MATCH + 1)
+        for pos in range(self.next_pos, stop):
+            self._insert(pos, self.max_depth, self.nice_length)
+        self.next_pos = max(self.next_pos, stop)
+
+    def skip(self, end):
+        """Moves on to end without inserting the positions before it."""
+        self.next_pos = max(self.next_pos, end)
+
+    def slide(self, n):
+        """Catches up with the first n bytes having been removed from the buffer."""
+        del self.tree[: 2 * n]
+        self.tree += array("q", [NIL]) * (2 * n)
+        self.offset += n
+        self.next_pos = max(self.next_pos - n, 0)
+
+    def matches(self, pos, max_depth=None, nice_length=None):
+        """Inserts pos, and returns its matches, shortest first.
+
+        The positions before pos must already have been inserted, and pos must
+        not have been. Each match is a (distance, length) tuple, and is the
+        closest one of at least its length."""
+        matches = []
+        if pos + MIN_MATCH <= len(self.buf):
+            self._insert(
+                pos,
+                self.max_depth if max_depth is None else max_depth,
+                self.nice_length if nice_length is None else nice_length,
+                matches,
+            )
+            self.next_pos = pos + 1
+        return matches
+
+    def longest_match(
+        self, pos, limit=0, prev_len=0, max_chain=None, nice_length=MAX_MATCH
+    ):
+        """Inserts pos, and finds the longest earlier string matching it.
+
+        Works the same as HashChain.longest_match, with max_chain as the depth
+        to search to."""
+        matches = self.matches(pos, max_chain, nice_length)
+        if not matches or matches[-1][1] <= prev_len:
+            return (0, 0)
+        distance, length = matches[-1]
+        if pos - distance < limit:
+            return (0, 0)
+        return (distance, length)
+
+
+class Lz77:
+    """Incremental LZ77 encoder.
+
+    Input can be fed in as it arrives, and is encoded as soon as there is enough
+    of it ahead to find the longest match. Matches reach back up to wsize bytes,
+    into input that has already been encoded or earlier in what hasn't. Input
+    is kept in a single window, like zlib's: once it holds twice wsize bytes,
+    whatever is more than wsize bytes behind the next position to encode has
+    gone out of reach, so it is dropped and the hash chains are moved down to
+    match. Matches can then go across where the window was
+    slid, and neither they nor their lengths depend on how input was fed in."""
+
+    def __init__(
+        self,
+        lz_io,
+        wsize=32 * 2**10,
+        config=DEFAULT_CONFIG,
+        strategy=Strategy.DEFAULT,
+        probe_distances=(),
+    ):
+        # Otherwise a window could fill up before anything could be encoded.
+        assert wsize >= MIN_LOOKAHEAD
+        assert all(0 < d <= wsize for d in probe_distances)
+        self.lz_io = lz_io
+        self.wsize = wsize
+        """Furthest back a match can go."""
+        self.config = config
+        self.strategy = strategy
+        self.probe_distances = probe_distances
+        self.window = bytearray()
+        """Input yet to be encoded, and up to wsize or so bytes before it."""
+        self.pos = 0
+        """Position in the window of the next byte to encode."""
+        self.match_finder = self._new_match_finder()
+        self.prev_dist = self.prev_len = 0
+        self.pending = False
+        """Whether the byte before pos has yet to be written, either as a literal
+        or as the start of the match in prev_dist and prev_len."""
+
+    def _new_match_finder(self):
+        config = self.config
+        if config.match_finder == MatchFinder.BINARY_TREE:
+            return BinaryTree(
+                self.window,
+                self.wsize,
+                config.max_chain,
+                config.nice_length,
+                2 * self.wsize,
+            )
+        return HashChain(
+            self.window, config.max_chain, self.probe_distances, 2 * self.wsize
         )
-        cur_lookahead_idx += matchlen
-    return cur_lookahead_idx
-
-
-def compress(inf, lz_io, wsize=32 * 2**10):
-    # Doesn't *necessarily* have to be the case, but probably should be.
-    assert wsize % 2 == 0
-    bufsize = wsize // 2
-    search_buf = inf.read(bufsize)
-    lookahead_buf = inf.read(bufsize)
-    frequencies = Counter()
-    # We maintain the loop invariant that the contents of the search buffer have:
-    # - Been added to the hash table.
-    # - Been written to output (as literals or backreferences).
-    # To initialize the loop, we write the search buffer as literals.
-    for sym in search_buf:
-        lz_io.write_literal(sym)
-    frequencies.update(search_buf)
-    while lookahead_buf:
-        print(f"processed {bufsize}")
-        # hash_chain = _hash_buf(search_buf)
-        cur_lookahead_idx = 0
-        # TODO: We don't consider making backreferences within the lookahead buffer,
-        # but that fact seems inefficient?
-        while cur_lookahead_idx < len(lookahead_buf):
-            cur_lookahead_idx = _process_next_input(
-                lz_io, frequencies, search_buf, lookahead_buf, cur_lookahead_idx
+
+    def feed(self, data):
+        """Adds input, encoding as much of it as can be."""
+        data = memoryview(data)
+        while data:
+            if len(self.window) == 2 * self.wsize:
+                self._slide()
+            room = 2 * self.wsize - len(self.window)
+            self.window += data[:room]
+            data = data[room:]
+            self._encode(len(self.window) - MIN_LOOKAHEAD)
+
+    def flush(self):
+        """Encodes all of the input fed so far, however little there is.
+
+        Later input can still match against it."""
+        self._encode(len(self.window))
+        if self.pending:
+            self.lz_io.write_literal(self.window[self.pos - 1])
+            self.pending = False
+        self.prev_len = 0
+
+    def set_dictionary(self, data):
+        """Primes the encoder with data to match against, before any input."""
+        self.window[:] = data[-self.wsize :]
+        self.pos = len(self.window)
+        self.match_finder = self._new_match_finder()
+        self.match_finder.insert(self.pos)
+
+    def reset(self):
+        """Forgets all past input, so that nothing later refers back to it."""
+        self.flush()
+        self.window.clear()
+        self.pos = 0
+        self.match_finder = self._new_match_finder()
+
+    def _slide(self):
+        """Drops the start of the window, which is now out of reach.
+
+        That's usually about half of it, but can be less if input is left
+        waiting to be encoded, as with OptimalLz77."""
+        n = self.pos - self.wsize
+        assert n > 0, "window is full of input yet to be encoded"
+        del self.window[:n]
+        self.pos -= n
+        self.match_finder.slide(n)
+
+    def _encode(self, end):
+        """Encodes the window up to end, or past it to finish the last match."""
+        if self.pos >= end:
+            return
+        match self.strategy:
+            case Strategy.HUFFMAN_ONLY:
+                for literal in self.window[self.pos : end]:
+                    self.lz_io.write_literal(literal)
+                self.pos = end
+            case Strategy.RLE:
+                self._encode_rle(end)
+            case _ if self.config.lazy:
+                self._encode_lazy(end)
+            case _:
+                self._encode_greedy(end)
+
+    def _keep_match(self, distance, length):
+        """Decides whether a short match is worth more than its literals."""
+        if length > 5:
+            return True
+        if self.strategy == Strategy.FILTERED:
+            return False
+        return length > MIN_MATCH or distance <= TOO_FAR
+
+    def _encode_greedy(self, end):
+        """Takes the longest match at each position, as soon as it is found."""
+        lz_io = self.lz_io
+        config = self.config
+        buf = self.window
+        wsize = self.wsize
+        match_finder = self.match_finder
+        pos = self.pos
+        match_finder.insert(pos)
+        while pos < end:
+            distance, length = match_finder.longest_match(
+                pos, max(pos - wsize, 0), nice_length=config.nice_length
             )
-        # TODO: Maybe slide the window as soon as we have less than MAX_MATCH left?
-        search_buf = lookahead_buf
-        lookahead_buf = inf.read(bufsize)
+            if length and self._keep_match(distance, length):
+                lz_io.write_backref(distance, length)
+                if length <= config.max_lazy:
+                    match_finder.insert(pos + length)
+                else:
+                    match_finder.insert(pos + 1)
+                    match_finder.skip(pos + length)
+                pos += length
+            else:
+                lz_io.write_literal(buf[pos])
+                pos += 1
+                match_finder.insert(pos)
+        self.pos = pos
+
+    def _encode_lazy(self, end):
+        """Holds off on each match until the next position has been checked.
+
+        If the next position has a longer match, the byte before it is written
+        as a literal instead, and the same goes for the match after that."""
+        lz_io = self.lz_io
+        config = self.config
+        buf = self.window
+        wsize = self.wsize
+        match_finder = self.match_finder
+        pos = self.pos
+        prev_dist = self.prev_dist
+        prev_len = self.prev_len
+        pending = self.pending
+        while pos < end:
+            match_finder.insert(pos)
+            distance = length = 0
+            if prev_len < config.max_lazy:
+                max_chain = config.max_chain
+                if prev_len >= config.good_length:
+                    max_chain >>= 2
+                distance, length = match_finder.longest_match(
+                    pos, max(pos - wsize, 0), prev_len, max_chain, config.nice_length
+                )
+                if length and not self._keep_match(distance, length):
+                    length = 0
+            if prev_len >= MIN_MATCH and length <= prev_len:
+                lz_io.write_backref(prev_dist, prev_len)
+                pos += prev_len - 1
+                prev_len = 0
+                pending = False
+            else:
+                if pending:
+                    lz_io.write_literal(buf[pos - 1])
+                pending = True
+                prev_dist = distance
+                prev_len = length
+                pos += 1
+        self.pos = pos
+        self.prev_dist = prev_dist
+        self.prev_len = prev_len
+        self.pending = pending
+
+    def _encode_rle(self, end):
+        """Only matches runs of the same byte, which needs no hash chains."""
+        lz_io = self.lz_io
+        buf = self.window
+        pos = self.pos
+        while pos < end:
+            length = 0
+            if pos > 0 and buf[pos - 1] == buf[pos]:
+                length = _match_length(
+                    buf, pos - 1, pos, min(MAX_MATCH, len(buf) - pos)
+                )
+            if length >= MIN_MATCH:
+                lz_io.write_backref(1, length)
+                pos += length
+            else:
+                lz_io.write_literal(buf[pos])
+                pos += 1
+        self.pos = pos
+
+
+def image_distances(stride, pixel_size, wsize=32 * 2**10):
+    """Picks distances to probe for matches in image data.
+
+    stride is the distance from a byte to the one above it, and pixel_size the
+    distance to the one to its left. The pixels above and to either side are
+    also likely matches. Distances beyond wsize, as in very wide images, are
+    left out."""
+    distances = {
+        pixel_size,
+        2 * pixel_size,
+        stride - pixel_size,
+        stride,
+        stride + pixel_size,
+        2 * stride,
+    }
+    return tuple(sorted(d for d in distances if 0 < d <= wsize))
+
+
+def compress(
+    inf,
+    lz_io,
+    wsize=32 * 2**10,
+    config=DEFAULT_CONFIG,
+    strategy=Strategy.DEFAULT,
+    probe_distances=(),
+):
+    """Encodes everything read from a file-like object."""
+    lz77 = Lz77(lz_io, wsize, config, strategy, probe_distances)
+    while data := inf.read(lz77.wsize):
+        lz77.feed(data)
+    lz77.flush()
+
+
+def main():
+    import random
+
+    class Recorder(LzIoInterface):
+        def __init__(self):
+            self.tokens = []
+
+        def write_literal(self, literal):
+            self.tokens.append(literal)
+
+        def write_backref(self, distance, length):
+            self.tokens.append((distance, length))
+
+    def encode(data, wsize=32 * 2**10, config=DEFAULT_CONFIG, chunk_size=None):
+        recorder = Recorder()
+        lz77 = Lz77(recorder, wsize, config)
+        chunk_size = chunk_size or len(data) or 1
+        for i in range(0, len(data), chunk_size):
+            lz77.feed(data[i : i + chunk_size])
+        lz77.flush()
+        return recorder.tokens
+
+    def decode(tokens, wsize=32 * 2**10):
+        out = bytearray()
+        for token in tokens:
+            if type(token) is int:
+                out.append(token)
+            else:
+                distance, length = token
+                assert 0 < distance <= min(wsize, len(out)), (distance, len(out))
+                for _ in range(length):
+                    out.append(out[-distance])
+        return bytes(out)
+
+    print("Test short inputs:")
+    for data in [b"", b"a", b"ab", b"abc", b"abcab", b"aaaa"]:
+        assert decode(encode(data)) == data
+
+    print("Test matches within the input not yet encoded:")
+    rng = random.Random(0)
+    noise = bytes(rng.randrange(256) for _ in range(100))
+    assert encode(noise + noise) == list(noise) + [(100, 100)]
+
+    print("Test matches that overlap what they repeat:")
+    assert encode(b"abc" * 100) == list(b"abc") + [(3, 258), (3, 39)]
+    pixels = b"\x10\x20\x30" * 100000
+    tokens = encode(pixels)
+    assert decode(tokens) == pixels
+    assert len(tokens) == 3 + -(-(len(pixels) - 3) // MAX_MATCH)
+
+    print("Test that output doesn't depend on how input is fed in:")
+    data = bytearray()
+    while len(data) < 10000:
+        data += noise[: rng.randrange(1, 100)] + bytes(rng.randrange(4))
+    for match_finder in MatchFinder:
+        for lazy in [True, False]:
+            config = DEFAULT_CONFIG._replace(lazy=lazy, match_finder=match_finder)
+            tokens = encode(data, 1024, config)
+            assert decode(tokens, 1024) == data
+            for chunk_size in [1, 7, 300, 1024]:
+                assert encode(data, 1024, config, chunk_size) == tokens
+
+    print("Test the binary tree against a scan of the whole window:")
+    data = bytearray()
+    while len(data) < 2000:
+        if data and rng.random() < 0.3:
+            start = rng.randrange(len(data))
+            data += data[start : start + rng.randrange(1, 400)]
+        else:
+            data += bytes(rng.choices(b"ab", k=rng.randrange(1, 20)))
+    wsize = 300
+    window = data[: 2 * wsize]
+    tree = BinaryTree(window, wsize, 2 * wsize, size=2 * wsize)
+    offset = 0
+    for pos in range(len(data) - MIN_MATCH + 1):
+        if pos - offset + MAX_MATCH > len(window) < len(data) - offset:
+            n = pos - offset - wsize
+            del window[:n]
+            window += data[offset + 2 * wsize : offset + n + 2 * wsize]
+            tree.slide(n)
+            offset += n
+        # Every match that is longer than all of the closer ones.
+        expected = []
+        max_len = min(MAX_MATCH, len(data) - pos)
+        for cand in range(pos - 1, max(pos - wsize, 0) - 1, -1):
+            length = _match_length(data, cand, pos, max_len)
+            if length > (expected[-1][1] if expected else MIN_MATCH - 1):
+                expected.append((pos - cand, length))
+        assert tree.matches(pos - offset) == expected, pos
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -19,8 +19,116 @@ def tui():
     return 0
 
 
+def _find_images(paths):
+    """Expands files, directories and globs into a list of BMP and PNG files.
+
+    Returns a list of (path, name) tuples, where name is the path relative to
+    the directory it was found in, or just the file name otherwise."""
+    import glob
+    import os
+
+    found = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    if os.path.splitext(filename)[1].lower() in (".bmp", ".png"):
+                        filename = os.path.join(dirpath, filename)
+                        found.setdefault(filename, os.path.relpath(filename, path))
+        elif any(c in path for c in "*?["):
+            for filename in sorted(glob.glob(path, recursive=True)):
+                found.setdefault(filename, os.path.basename(filename))
+        else:
+            found.setdefault(path, os.path.basename(path))
+    # Dictionaries keep their order, so this drops duplicates but keeps it.
+    return list(found.items())
+
+
+def _format_rate(size, seconds):
+    mib = size / 2**20
+    return f"{mib:.2f} MiB in {seconds:.2f} s ({mib / max(seconds, 1e-9):.2f} MiB/s)"
+
+
+def convert(args):
+    import os
+    import time
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    from convert import convert_file, output_filename
+
+    start = time.perf_counter()
+    tasks = []
+    failed = 0
+    srcs = _find_images(args.paths)
+    src_set = {src for src, _ in srcs}
+    dsts = {}
+    for src, name in srcs:
+        try:
+            dst = output_filename(src)
+            if args.output_dir is not None:
+                # Keep the layout of directories that were walked, so that files
+                # of the same name in different ones don't collide.
+                dst = os.path.join(args.output_dir, output_filename(name))
+        except ValueError as e:
+            print(f"{src}: {e}")
+            failed += 1
+            continue
+        if dst in dsts:
+            print(f"{src}: {dsts[dst]} is also converted to {dst}, skipping")
+            failed += 1
+            continue
+        dsts[dst] = src
+        if dst in src_set and os.path.getmtime(src) >= os.path.getmtime(dst):
+            # Given a BMP and a PNG of the same name, the newer one was presumably
+            # converted from the older, and shouldn't be converted back over it.
+            print(f"{src}: presumably converted from {dst}, skipping")
+            continue
+        if not args.force and os.path.exists(dst):
+            # An older output may just as well be the original the input was
+            # made from, so only --force writes over it.
+            if os.path.getmtime(dst) >= os.path.getmtime(src):
+                print(f"{src}: {dst} is up to date, skipping")
+            else:
+                print(f"{src}: {dst} already exists, skipping (use --force)")
+            continue
+        tasks.append((src, dst))
+        if args.output_dir is not None:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+    total_in = 0
+    done = 0
+    with ProcessPoolExecutor(args.jobs) as executor:
+        futures = {
+            executor.submit(convert_file, src, dst, args.level): (src, dst)
+            for src, dst in tasks
+        }
+        for future in as_completed(futures):
+            src, dst = futures[future]
+            try:
+                size_in, size_out, seconds = future.result()
+            except Exception as e:
+                # Anything can go wrong with a malformed file (truncated ones
+                # fail in struct.unpack), but it shouldn't stop the others.
+                print(f"{src}: {e}")
+                failed += 1
+                continue
+            print(f"{src} -> {dst}: {_format_rate(size_in, seconds)}")
+            total_in += size_in
+            done += 1
+
+    seconds = time.perf_counter() - start
+    print(f"converted {done} files, {_format_rate(total_in, seconds)}")
+    if failed:
+        print(f"{failed} files failed")
+        return 1
+    return 0
+
+
 def cli():
     import argparse
+    import os
+
+    import zlib_
 
     parser = argparse.ArgumentParser(
         prog="bmpng",
@@ -30,6 +138,38 @@ def cli():
     subparsers.add_parser("cli", help="use the command line interface (default)")
     subparsers.add_parser("tui", help="use the text user interface")
     subparsers.add_parser("gui", help="use the graphical user interface")
+    convert_parser = subparsers.add_parser(
+        "convert", help="convert BMP files to PNG, and PNG files to BMP"
+    )
+    convert_parser.add_argument(
+        "paths", nargs="+", help="files, directories or globs to convert"
+    )
+    convert_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of files to convert at once (default: number of CPUs)",
+    )
+    convert_parser.add_argument(
+        "-l",
+        "--level",
+        type=int,
+        choices=range(-1, zlib_.MAX_LEVEL + 1),
+        default=-1,
+        metavar=f"{{0-{zlib_.MAX_LEVEL}}}",
+        help="compression level for PNG output, where levels above "
+        f"{zlib_.Z_BEST_COMPRESSION} are much slower (default: 6)",
+    )
+    convert_parser.add_argument(
+        "-o", "--output-dir", help="directory to write output to (default: alongside)"
+    )
+    convert_parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="overwrite outputs that already exist",
+    )
 
     args = parser.parse_args()
 
@@ -37,8 +177,10 @@ def cli():
         return gui()
     elif args.interface == "tui":
         return tui()
+    elif args.interface == "convert":
+        return convert(args)
 
-    print("CLI not implemented yet")
+    parser.print_help()
     return 0
 
 
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Lucy Loerker, Maxwell Parker-Blue
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+from bisect import bisect_left, bisect_right
+
+import lz77
+from deflate import (
+    END_OF_BLOCK,
+    MAX_BITS,
+    NUM_DISTANCE_SYMBOLS,
+    NUM_LITERALLENGTH_SYMBOLS,
+    distance_symbol,
+    distance_symbol_info,
+    fixed_d_lengths,
+    fixed_ll_lengths,
+    length_codes,
+)
+from huffman import code_lengths
+
+# Greedy and lazy matching decide on each match as they come to it. Optimal
+# parsing, as in Zopfli, instead finds the cheapest way to write a whole block
+# as literals and matches, as a shortest path: position i of the block is a
+# node, with an edge to i + 1 for a literal and to i + length for each match at
+# i, weighted by how many bits it takes to write.
+#
+# Those weights come from the Huffman codes that the block will be written
+# with, which depend on the path taken. So we start out with the costs of the
+# fixed codes, and work out the codes for each path found to weigh the next
+# one. Whichever path comes out smallest with its own codes is the one written.
+
+LENGTH_STEPS = [
+    length
+    for length in range(lz77.MIN_MATCH, lz77.MAX_MATCH + 1)
+    if length == lz77.MAX_MATCH
+    or length_codes[length].symbol != length_codes[length + 1].symbol
+]
+"""Longest length with each length symbol.
+
+Lengths with the same symbol cost the same, so of a match's lengths, we only
+try these and the full length of the match. Trying every length would take a
+few times longer, for very little."""
+
+
+def _bit_costs(lengths, fixed_lengths):
+    """Turns code lengths into the cost of each symbol in bits.
+
+    Symbols that aren't in the code would have to be added to it, so they cost
+    one more bit than the longest code. If there are no codes at all, the fixed
+    ones are used instead."""
+    if not any(lengths):
+        return list(fixed_lengths)
+    unused = min(max(lengths) + 1, MAX_BITS)
+    return [n or unused for n in lengths]
+
+
+def _block_cost(tokens):
+    """Works out the codes for writing a parse, and how many bits it takes.
+
+    Returns the number of bits (not counting the block header), and the code
+    lengths for the literal/length and distance alphabets."""
+    ll_freq = [0] * NUM_LITERALLENGTH_SYMBOLS
+    d_freq = [0] * NUM_DISTANCE_SYMBOLS
+    extra = 0
+    for token in tokens:
+        if type(token) is int:
+            ll_freq[token] += 1
+        else:
+            distance, length = token
+            code = length_codes[length]
+            ll_freq[code.symbol] += 1
+            dsym = distance_symbol(distance)
+            d_freq[dsym] += 1
+            extra += code.num_extra_bits + distance_symbol_info[dsym].num_extra_bits
+    ll_freq[END_OF_BLOCK] += 1
+    ll_lengths = code_lengths(ll_freq, MAX_BITS)
+    d_lengths = code_lengths(d_freq, MAX_BITS)
+    bits = extra
+    bits += sum(freq * n for freq, n in zip(ll_freq, ll_lengths))
+    bits += sum(freq * n for freq, n in zip(d_freq, d_lengths))
+    return bits, ll_lengths, d_lengths
+
+
+def _shortest_path(block, matches, ll_lengths, d_lengths):
+    """Finds the cheapest parse of a block, given the matches at each position.
+
+    Returns the literals (as ints) and back-references (as tuples) to write."""
+    ll_costs = _bit_costs(ll_lengths, fixed_ll_lengths)
+    d_costs = _bit_costs(d_lengths, fixed_d_lengths)
+    length_costs = [0] * lz77.MIN_MATCH + [
+        ll_costs[code.symbol] + code.num_extra_bits
+        for code in length_codes[lz77.MIN_MATCH :]
+    ]
+    dsym_costs = [
+        d_costs[dsym] + distance_symbol_info[dsym].num_extra_bits
+        for dsym in range(NUM_DISTANCE_SYMBOLS)
+    ]
+    n = len(block)
+    cost = [float("inf")] * (n + 1)
+    cost[0] = 0
+    step = [None] * (n + 1)
+    """Last literal or back-reference on the cheapest path to each position."""
+    for i in range(n):
+        base = cost[i]
+        literal = block[i]
+        c = base + ll_costs[literal]
+        if c < cost[i + 1]:
+            cost[i + 1] = c
+            step[i + 1] = literal
+        prev_len = lz77.MIN_MATCH - 1
+        for dsym, distance, length in matches[i]:
+            length = min(length, n - i)
+            if length <= prev_len:
+                break
+            match_base = base + dsym_costs[dsym]
+            lo = bisect_right(LENGTH_STEPS, prev_len)
+            hi = bisect_left(LENGTH_STEPS, length)
+            for cur_len in LENGTH_STEPS[lo:hi] + [length]:
+                c = match_base + length_costs[cur_len]
+                if c < cost[i + cur_len]:
+                    cost[i + cur_len] = c
+                    step[i + cur_len] = (distance, cur_len)
+            prev_len = length
+    tokens = []
+    while n > 0:
+        token = step[n]
+        tokens.append(token)
+        n -= 1 if type(token) is int else token[1]
+    tokens.reverse()
+    return tokens
+
+
+class OptimalLz77(lz77.Lz77):
+    """LZ77 encoder that parses input optimally, for the smallest output.
+
+    The matches at each position are found as soon as there is enough input
+    ahead of it, as usual, but the choice between them is put off until a whole
+    block's worth has built up. Then the block is parsed config.passes times,
+    and ended with lz_io.flush() so that it gets the Huffman codes it was parsed
+    for, so lz_io should be a deflate.BlockWriter. Matches are always found
+    with a binary tree, since the shorter ones are needed as well as the
+    longest. Since the costs already weigh short matches against literals,
+    Z_FILTERED makes no difference here."""
+
+    BLOCK_SIZE = 2**14
+    """Number of positions to parse at a time."""
+
+    def __init__(
+        self,
+        lz_io,
+        wsize=32 * 2**10,
+        config=lz77.DEFAULT_CONFIG,
+        strategy=lz77.Strategy.DEFAULT,
+        probe_distances=(),
+        block_size=BLOCK_SIZE,
+    ):
+        super().__init__(lz_io, wsize, config, strategy, probe_distances)
+        self.block_size = block_size
+        self.block = bytearray()
+        """Input that has had its matches found, but has yet to be parsed."""
+        self.block_matches = []
+        """Matches at each position in block, as (distance symbol, distance,
+        length) tuples, shortest first."""
+
+    def _new_match_finder(self):
+        config = self.config
+        return lz77.BinaryTree(
+            self.window,
+            self.wsize,
+            config.max_chain,
+            config.nice_length,
+            2 * self.wsize,
+        )
+
+    def flush(self):
+        super().flush()
+        if self.block:
+            self._encode_block()
+
+    def _encode(self, end):
+        if self.strategy in (lz77.Strategy.HUFFMAN_ONLY, lz77.Strategy.RLE):
+            super()._encode(end)
+            return
+        buf = self.window
+        match_finder = self.match_finder
+        pos = self.pos
+        match_finder.insert(pos)
+        while pos < end:
+            found = []
+            for distance, length in match_finder.matches(pos):
+                found.append((distance_symbol(distance), distance, length))
+            self.block.append(buf[pos])
+            self.block_matches.append(found)
+            pos += 1
+            if len(self.block) >= self.block_size:
+                self._encode_block()
+        self.pos = pos
+
+    def _encode_block(self):
+        best = best_bits = None
+        ll_lengths = fixed_ll_lengths
+        d_lengths = fixed_d_lengths
+        for _ in range(self.config.passes):
+            tokens = _shortest_path(
+                self.block, self.block_matches, ll_lengths, d_lengths
+            )
+            bits, ll_lengths, d_lengths = _block_cost(tokens)
+            if best_bits is None or bits < best_bits:
+                best = tokens
+                best_bits = bits
+        lz_io = self.lz_io
+        for token in best:
+            if type(token) is int:
+                lz_io.write_literal(token)
+            else:
+                lz_io.write_backref(*token)
+        lz_io.flush()
+        self.block.clear()
+        self.block_matches.clear()
+
+
+def main():
+    import random
+    import zlib
+
+    import zlib_
+
+    print("Test optimal parsing against zlib:")
+    rng = random.Random(0)
+    words = [bytes(rng.choices(b"abcdefgh ", k=rng.randrange(2, 9))) for _ in range(50)]
+    data = b" ".join(rng.choice(words) for _ in range(4000))
+    data += b"\x10\x20\x30" * 1000 + bytes(rng.randrange(256) for _ in range(1000))
+    for level in [zlib_.Z_BEST_COMPRESSION, zlib_.MAX_LEVEL]:
+        compressor = zlib_.Compressor(level)
+        compressed = compressor.compress(data) + compressor.flush()
+        assert zlib.decompress(compressed) == data
+        print(level, len(compressed), len(zlib.compress(data, 9)))
+
+    print("Test input that is longer than the window:")
+    data = data[:3000] * 12
+    for wbits in [zlib_.MIN_WBITS, zlib_.MAX_WBITS]:
+        sizes = []
+        for level in [zlib_.Z_BEST_COMPRESSION, zlib_.MAX_LEVEL]:
+            compressor = zlib_.Compressor(level, wbits)
+            compressed = compressor.compress(data) + compressor.flush()
+            assert zlib.decompress(compressed) == data
+            sizes.append(len(compressed))
+        print(wbits, *sizes)
+        assert sizes[1] <= sizes[0]
+
+
+if __name__ == "__main__":
+    exit(main())
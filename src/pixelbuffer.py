@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# Copyright 2023 Lucy Loerker, Maxwell Parker-Blue
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class PixelBuffer:
+    """Image stored in one contiguous buffer of 8-bit samples.
+
+    Rows go from top to bottom, and each pixel's channels are stored together, in
+    the order red, green, blue (and alpha, if there are 4 channels). Grayscale
+    images have 1 channel, or 2 with alpha. Rows start every stride bytes, which
+    may be more than the width times the number of channels if rows are padded.
+    """
+
+    def __init__(self, width, height, channels=3, data=None, stride=None):
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.row_size = width * channels
+        """Number of bytes of pixels in each row, not counting padding."""
+        self.stride = self.row_size if stride is None else stride
+        """Number of bytes from the start of one row to the start of the next."""
+        if data is None:
+            data = bytearray(self.stride * height)
+        elif len(data) < self.stride * height:
+            raise ValueError("buffer is too small for the image")
+        self.data = data
+        """Underlying buffer, which can be anything supporting the buffer protocol."""
+
+    @classmethod
+    def from_array(cls, array):
+        """Makes a buffer from a list of columns of pixel tuples, indexed [x][y]."""
+        width = len(array)
+        height = len(array[0])
+        pixels = cls(width, height, len(array[0][0]))
+        for y in range(height):
+            pixels.set_row(y, bytes(c for column in array for c in column[y]))
+        return pixels
+
+    def row(self, y):
+        """Returns a view of the pixels in a row, without copying them."""
+        start = y * self.stride
+        return memoryview(self.data)[start : start + self.row_size]
+
+    def rows(self):
+        for y in range(self.height):
+            yield self.row(y)
+
+    def set_row(self, y, data):
+        start = y * self.stride
+        self.data[start : start + self.row_size] = data
+
+    def __getitem__(self, xy):
+        """Returns the pixel at (x, y) as a tuple of channels."""
+        x, y = xy
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError("pixel out of range")
+        start = y * self.stride + x * self.channels
+        return tuple(self.data[start : start + self.channels])
+
+    def __setitem__(self, xy, pixel):
+        x, y = xy
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError("pixel out of range")
+        start = y * self.stride + x * self.channels
+        self.data[start : start + self.channels] = bytes(pixel)
+
+    def __eq__(self, other):
+        if not isinstance(other, PixelBuffer):
+            return NotImplemented
+        return (
+            self.width == other.width
+            and self.height == other.height
+            and self.channels == other.channels
+            and all(a == b for a, b in zip(self.rows(), other.rows()))
+        )
+
+    def to_numpy(self):
+        """Returns a (height, width, channels) NumPy array sharing the buffer."""
+        if np is None:
+            raise ImportError("NumPy is required to convert to an array")
+        arr = np.frombuffer(self.data, dtype=np.uint8, count=self.stride * self.height)
+        arr = arr.reshape(self.height, self.stride)[:, : self.row_size]
+        return arr.reshape(self.height, self.width, self.channels)
+
+    def to_ppm(self):
+        """Encodes the image as a binary PPM, dropping any alpha channel.
+
+        PPM is about the simplest format there is, and it's one that Tk can
+        display without any help."""
+        data = bytearray(f"P6\n{self.width} {self.height}\n255\n".encode())
+        for row in self.rows():
+            match self.channels:
+                case 1 | 2:
+                    gray = row[:: self.channels]
+                    rgb = bytearray(3 * self.width)
+                    rgb[0::3] = rgb[1::3] = rgb[2::3] = gray
+                    data += rgb
+                case 3:
+                    data += row
+                case 4:
+                    rgb = bytearray(3 * self.width)
+                    for c in range(3):
+                        rgb[c::3] = row[c::4]
+                    data += rgb
+        return bytes(data)
+
+
+def main():
+    print("Test pixel access:")
+    pixels = PixelBuffer(3, 2, stride=12)
+    pixels[2, 1] = (1, 2, 3)
+    assert pixels[2, 1] == (1, 2, 3)
+    assert bytes(pixels.row(1)) == bytes(6) + b"\x01\x02\x03"
+    assert pixels.data[18:21] == b"\x01\x02\x03"
+
+    print("Test conversion from nested lists:")
+    array = [[(x, y, x + y) for y in range(2)] for x in range(3)]
+    other = PixelBuffer.from_array(array)
+    assert other[1, 1] == (1, 1, 2)
+    assert other != pixels
+    other[0, 1] = other[1, 1] = (0, 0, 0)
+    other.set_row(0, bytes(9))
+    other[2, 1] = (1, 2, 3)
+    assert other == pixels
+
+    print("Test PPM:")
+    assert pixels.to_ppm() == b"P6\n3 2\n255\n" + bytes(15) + b"\x01\x02\x03"
+
+    if np is not None:
+        print("Test NumPy view:")
+        arr = pixels.to_numpy()
+        assert arr.shape == (2, 3, 3) and arr[1, 2, 2] == 3
+        arr[0, 0, 0] = 9
+        assert pixels[0, 0] == (9, 0, 0)
+
+
+if __name__ == "__main__":
+    exit(main())
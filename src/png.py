@@ -6,8 +6,67 @@
 import io
 import struct
 from dataclasses import dataclass
+from enum import IntEnum
 
+import lz77
 import zlib_
+from crc32 import crc32
+from filters import FilterType, Heuristic, filter_rows, unfilter_rows
+from pixelbuffer import PixelBuffer
+
+
+class ColorType(IntEnum):
+    GRAYSCALE = 0
+    TRUECOLOR = 2
+    INDEXED = 3
+    GRAYSCALE_ALPHA = 4
+    TRUECOLOR_ALPHA = 6
+
+
+CHANNELS = {
+    ColorType.GRAYSCALE: 1,
+    ColorType.TRUECOLOR: 3,
+    ColorType.INDEXED: 1,
+    ColorType.GRAYSCALE_ALPHA: 2,
+    ColorType.TRUECOLOR_ALPHA: 4,
+}
+BIT_DEPTHS = {
+    ColorType.GRAYSCALE: (1, 2, 4, 8, 16),
+    ColorType.TRUECOLOR: (8, 16),
+    ColorType.INDEXED: (1, 2, 4, 8),
+    ColorType.GRAYSCALE_ALPHA: (8, 16),
+    ColorType.TRUECOLOR_ALPHA: (8, 16),
+}
+"""Bit depths allowed for each color type."""
+CHANNEL_COLOR_TYPES = {
+    1: ColorType.GRAYSCALE,
+    2: ColorType.GRAYSCALE_ALPHA,
+    3: ColorType.TRUECOLOR,
+    4: ColorType.TRUECOLOR_ALPHA,
+}
+"""Color type to encode a pixel buffer as, by its number of channels."""
+IDAT_SIZE = 8 * 2**10
+"""Most compressed data to put in each IDAT chunk."""
+ADAM7 = (
+    (0, 0, 8, 8),
+    (4, 0, 8, 8),
+    (0, 4, 4, 8),
+    (2, 0, 4, 4),
+    (0, 2, 2, 4),
+    (1, 0, 2, 2),
+    (0, 1, 1, 2),
+)
+"""Starting x, starting y, x step and y step of each pass of an interlaced image."""
+
+
+def _make_unpack_table(depth, scale):
+    """Maps a byte to the samples packed into it, each multiplied by scale."""
+    per_byte = 8 // depth
+    mask = (1 << depth) - 1
+    return [
+        bytes((byte >> (8 - depth * (k + 1)) & mask) * scale for k in range(per_byte))
+        for byte in range(256)
+    ]
 
 
 @dataclass
@@ -36,7 +95,7 @@ class Png:
 
         # Inclusion of chunk_type signifies creation of chunk, not extraction
         # Empty parameters signifies IEND chunk
-        def __init__(self, data=None, chunk_type=None):
+        def __init__(self, data=None, chunk_type=None, verify_crc=True):
             if data is None:
                 self.type = b"IEND"
                 self.length = 0
@@ -52,6 +111,11 @@ class Png:
             self.length, self.type = struct.unpack(self.FMT, data.read(8))
             self.data = data.read(self.length)
             self.crc = data.read(4)
+            if verify_crc:
+                crc = self.crc
+                self.calc_crc()
+                if self.crc != crc:
+                    raise ValueError(f"CRC mismatch in {self.type.decode()} chunk")
 
         def __bytes__(self):
             data = bytearray()
@@ -61,7 +125,7 @@ class Png:
             return bytes(data)
 
         @classmethod
-        def make_chunk(cls, data=None):
+        def make_chunk(cls, data=None, verify_crc=True):
             if data is None:
                 return
             position = data.tell()
@@ -69,36 +133,28 @@ class Png:
             data.seek(position)
             match chunk:
                 case b"IHDR":
-                    return Png.Ihdr(data)
+                    return Png.Ihdr(data, verify_crc=verify_crc)
                 case _:
-                    return cls(data)
+                    return cls(data, verify_crc=verify_crc)
 
-        # Adapted from W3's sample C implementation
         def calc_crc(self):
-            crc_table = []
-            for n in range(256):
-                c = n
-                for k in range(8):
-                    if c & 1:
-                        c = 0xEDB88320 ^ (c >> 1)
-                    else:
-                        c >>= 1
-                crc_table.append(c)
-            crc = 0xFFFFFFFF
-            for n in range(4):
-                crc = crc_table[(crc ^ self.type[n]) & 0xFF] ^ (crc >> 8)
-            for n in range(self.length):
-                crc = crc_table[(crc ^ self.data[n]) & 0xFF] ^ (crc >> 8)
-            crc ^= 0xFFFFFFFF
-            self.crc = struct.pack("!I", crc)
+            # The CRC covers the chunk type and data, but not the length.
+            self.crc = struct.pack("!I", crc32(self.data, crc32(self.type)))
 
     @dataclass
     class Ihdr(Chunk):
         FMT2 = "!LL5B"
 
-        def __init__(self, data=None, width=None, height=None):
+        def __init__(
+            self,
+            data=None,
+            width=None,
+            height=None,
+            verify_crc=True,
+            color_type=ColorType.TRUECOLOR,
+        ):
             if data is not None:
-                super().__init__(data)
+                super().__init__(data, verify_crc=verify_crc)
                 (
                     self.width,
                     self.height,
@@ -114,7 +170,7 @@ class Png:
                 self.width = width
                 self.height = height
                 self.bit_depth = 8
-                self.color_type = 2
+                self.color_type = color_type
                 self.compression = 0
                 self.filter = 0
                 self.interlace = 0
@@ -135,30 +191,53 @@ class Png:
     ihdr = None
     plte = None
 
-    def __init__(self, filename=None, array=None):
+    def __init__(
+        self,
+        filename=None,
+        array=None,
+        verify_crc=True,
+        heuristic=Heuristic.MIN_SUM,
+        filter_type=FilterType.NONE,
+    ):
         if filename is not None:
-            in_file = open(filename, "rb")
-            self.header = self.Header(in_file)
+            with open(filename, "rb") as in_file:
+                self.header = self.Header(in_file)
+                if self.header.valid:
+                    self.chunks = []
+                    idats = []
+                    chunk = self.Chunk.make_chunk(in_file, verify_crc)
+                    while chunk.type != b"IEND":
+                        match chunk.type:
+                            case b"IHDR":
+                                self.ihdr = chunk
+                            case b"PLTE":
+                                self.plte = chunk
+                            case b"IDAT":
+                                idats.append(chunk.data)
+                            case _:
+                                self.chunks.append(chunk)
+                        chunk = self.Chunk.make_chunk(in_file, verify_crc)
+                    self.compressed_data = b"".join(idats)
             if self.header.valid:
-                self.chunks = []
-                chunk = self.Chunk.make_chunk(in_file)
-                while chunk.type != b"IEND":
-                    match chunk.type:
-                        case b"IHDR":
-                            self.ihdr = chunk
-                        case b"PLTE":
-                            self.plte = chunk
-                        case b"IDAT":
-                            self.compressed_data += chunk.data
-                        case _:
-                            self.chunks.append(chunk)
-                    chunk = self.Chunk.make_chunk(in_file)
-            in_file.close()
+                self.decode()
         elif array is not None:
             self.header = self.Header()
-            self.ihdr = self.Ihdr(width=len(array), height=len(array[0]))
-            self.array_to_bytes(array)
-            self.compressed_data = bytes(zlib_.compress(io.BytesIO(self.raw_data)))
+            self.ihdr = self.Ihdr(
+                width=array.width,
+                height=array.height,
+                color_type=CHANNEL_COLOR_TYPES[array.channels],
+            )
+            self.array_to_bytes(array, heuristic, filter_type)
+            # Like libpng, we assume that filtered data suits Z_FILTERED. Each
+            # row is preceded by its filter type byte.
+            probes = lz77.image_distances(array.row_size + 1, array.channels)
+            self.compressed_data = bytes(
+                zlib_.compress(
+                    io.BytesIO(self.raw_data),
+                    strategy=zlib_.Z_FILTERED,
+                    probe_distances=probes,
+                )
+            )
 
     def __bytes__(self):
         data = bytearray()
@@ -169,24 +248,93 @@ class Png:
         if self.chunks is not None:
             for chunk in self.chunks:
                 data += bytes(chunk)
-        for i in range(0, len(self.compressed_data), 8*1024):
-            compressed_data = self.compressed_data[i:i+8*1024]
+        for i in range(0, len(self.compressed_data), IDAT_SIZE):
+            compressed_data = self.compressed_data[i : i + IDAT_SIZE]
             idat = self.Chunk(data=compressed_data, chunk_type=b"IDAT")
             data += bytes(idat)
         data += bytes(self.Chunk())
         return bytes(data)
 
-    def array_to_bytes(self, array):
-        self.raw_data = bytearray()
-        for i in range(len(array[0])):
-            self.raw_data += struct.pack("x")
-            for j in range(len(array)):
-                self.raw_data += struct.pack(
-                    "!BBB",
-                    array[j][i][0],
-                    array[j][i][1],
-                    array[j][i][2],
-                )
+    def decode(self):
+        """Inflates and unfilters the image data into a pixel buffer.
+
+        Grayscale images keep their 1 or 2 channels, indexed colors are looked up
+        in the palette to give 3, and every sample is scaled to 8 bits."""
+        ihdr = self.ihdr
+        if ihdr is None:
+            raise ValueError("missing IHDR chunk")
+        if ihdr.bit_depth not in BIT_DEPTHS.get(ihdr.color_type, ()):
+            raise ValueError(
+                f"invalid bit depth {ihdr.bit_depth} for color type {ihdr.color_type}"
+            )
+        if ihdr.compression != 0 or ihdr.filter != 0 or ihdr.interlace > 1:
+            raise ValueError("unknown compression, filter or interlace method")
+        color_type = ColorType(ihdr.color_type)
+        palette = None
+        if color_type == ColorType.INDEXED:
+            if self.plte is None:
+                raise ValueError("missing PLTE chunk")
+            palette = self.plte.data
+            palette = [palette[i : i + 3] for i in range(0, len(palette) - 2, 3)]
+        data = zlib_.decompress(io.BytesIO(self.compressed_data))
+        bits_per_pixel = CHANNELS[color_type] * ihdr.bit_depth
+        bpp = max(1, bits_per_pixel // 8)
+        channels = 3 if palette is not None else CHANNELS[color_type]
+        unpack = None
+        if ihdr.bit_depth < 8:
+            # Indices into the palette are used as they are.
+            scale = 1 if palette is not None else 255 // ((1 << ihdr.bit_depth) - 1)
+            unpack = _make_unpack_table(ihdr.bit_depth, scale)
+        self.pixels = PixelBuffer(ihdr.width, ihdr.height, channels)
+        start = 0
+        for x0, y0, dx, dy in ADAM7 if ihdr.interlace else ((0, 0, 1, 1),):
+            width = (ihdr.width - x0 + dx - 1) // dx
+            height = (ihdr.height - y0 + dy - 1) // dy
+            if width == 0 or height == 0:
+                continue
+            row_size = (width * bits_per_pixel + 7) // 8
+            end = start + (row_size + 1) * height
+            rows = unfilter_rows(data[start:end], row_size, height, bpp)
+            start = end
+            for j, row in enumerate(rows):
+                samples = self._row_to_samples(row, width, palette, unpack)
+                y = y0 + j * dy
+                if dx == 1:
+                    self.pixels.set_row(y, samples)
+                    continue
+                # Spread the pass's pixels out across the row, a channel at a time.
+                row_start = y * self.pixels.stride
+                row_end = row_start + self.pixels.row_size
+                for c in range(channels):
+                    self.pixels.data[
+                        row_start + x0 * channels + c : row_end : dx * channels
+                    ] = samples[c::channels]
+
+    def _row_to_samples(self, row, width, palette, unpack=None):
+        """Converts a row of unfiltered bytes into 8-bit samples.
+
+        unpack is the table from _make_unpack_table, for depths below 8."""
+        depth = self.ihdr.bit_depth
+        if depth == 16:
+            # Keep only the most significant byte of each sample.
+            samples = row[::2]
+        elif depth < 8:
+            samples = b"".join(map(unpack.__getitem__, row))[:width]
+        else:
+            samples = row
+        if palette is not None:
+            try:
+                return b"".join(map(palette.__getitem__, samples))
+            except IndexError:
+                raise ValueError("palette index out of range") from None
+        return samples
+
+    def array_to_bytes(
+        self, array, heuristic=Heuristic.MIN_SUM, filter_type=FilterType.NONE
+    ):
+        """Filters the rows of a pixel buffer into raw image data."""
+        bpp = array.channels
+        self.raw_data = filter_rows(array.rows(), bpp, heuristic, filter_type)
 
 
 if __name__ == "__main__":
@@ -207,11 +355,10 @@ if __name__ == "__main__":
     #     for chunk in png.chunks:
     #         print(f"Chunk length: {chunk.length} bytes")
     #         print(f"Chunk type: {chunk.type}")
-    image = []
+    image = PixelBuffer(256, 256)
     for x in range(256):
-        image.append([])
         for y in range(256):
-            image[x].append((x, 0, y))
+            image[x, y] = (x, 0, y)
     png = Png(array=image)
     output = open("png_test.png", "wb")
     output.write(bytes(png))
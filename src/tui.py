@@ -4,7 +4,7 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 from bmp import Bmp
-from png import Png
+from convert import bmp_to_png
 
 def main_loop():
     filename = input("what bmp file would you like to open? (type EXIT to close program) ")
@@ -13,10 +13,9 @@ def main_loop():
         quit()
     bmp = Bmp(filename=filename)
     if bmp.header.valid:
-        png = Png(array=bmp.arr)
-        output = open(filename.rstrip("bmp") + "png", "wb")
-        output.write(bytes(png))
-        output.close()
+        with open(filename, "rb") as in_file:
+            with open(filename.rstrip("bmp") + "png", "wb") as output:
+                bmp_to_png(in_file, output)
         print("it's valid!:3")
         print("size = " + str(bmp.header.size) + " bytes")
         print("pixel array starting address: " + str(bmp.header.offset))
@@ -47,13 +46,13 @@ def main_loop():
             if x == 0 or y == 0:
                 print("please use 1-indexing")
                 continue
-            if x > bmp.dib.width or y > bmp.dib.height:
+            if x > bmp.pixels.width or y > bmp.pixels.height:
                 print("please give a pixel that is in range of the image")
                 continue
             if x < 0 or y < 0:
                 print("please no negatives :(")
                 continue
-            pixel = bmp.arr[x - 1][y - 1]
+            pixel = bmp.pixels[x - 1, y - 1]
             red = pixel[0]
             green = pixel[1]
             blue = pixel[2]
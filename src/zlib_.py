@@ -4,24 +4,69 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 
 import io
-import math
+import os
 import struct
-from collections import Counter
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from enum import IntEnum
+import adler32
 import deflate
-from bitwriter import BitWriter
+import inflate
 import lz77
+import optimal
+from bitwriter import BitWriter
 
 # zlib container RFC: https://www.rfc-editor.org/rfc/rfc1950
 
 Z_NO_COMPRESSION = 0
 Z_BEST_COMPRESSION = 9
+"""Highest level that zlib itself has."""
+MAX_LEVEL = 12
 Z_DEFAULT_COMPRESSION = -1
 
 MIN_WBITS = 9
 MAX_WBITS = 15
 
+Z_NO_FLUSH = 0
+Z_SYNC_FLUSH = 2
+Z_FULL_FLUSH = 3
+Z_FINISH = 4
+
+Z_DEFAULT_STRATEGY = lz77.Strategy.DEFAULT
+Z_FILTERED = lz77.Strategy.FILTERED
+Z_HUFFMAN_ONLY = lz77.Strategy.HUFFMAN_ONLY
+Z_RLE = lz77.Strategy.RLE
+
+CONFIGS = [
+    None,
+    # Greedy matching, for speed.
+    lz77.Config(4, 4, 8, 4, False),
+    lz77.Config(4, 5, 16, 8, False),
+    lz77.Config(4, 6, 32, 32, False),
+    # Lazy matching.
+    lz77.Config(4, 4, 16, 16, True),
+    lz77.Config(8, 16, 32, 32, True),
+    lz77.Config(8, 16, 128, 128, True),
+    lz77.Config(8, 32, 128, 256, True),
+    lz77.Config(32, 128, 258, 1024, True),
+    lz77.Config(32, 258, 258, 4096, True),
+    # Optimal parsing, for when output size matters far more than time.
+    lz77.Config(32, 258, 258, 32, True, lz77.MatchFinder.BINARY_TREE, 2),
+    lz77.Config(32, 258, 258, 64, True, lz77.MatchFinder.BINARY_TREE, 5),
+    lz77.Config(32, 258, 258, 128, True, lz77.MatchFinder.BINARY_TREE, 10),
+]
+"""Match finding configuration for each compression level, the same as zlib's
+up to Z_BEST_COMPRESSION.
+
+Level 0 doesn't look for matches at all, and just writes stored blocks. Like
+libdeflate, we go on past zlib's levels, to ones that are much slower."""
+
+CHUNK_SIZE = 2**16
+"""Amount of input to read at a time."""
+SEGMENT_SIZE = 2**18
+"""Amount of input for each process to compress at a time, in parallel mode."""
+
 
 class CompressionMethod(IntEnum):
     DEFLATE = 8
@@ -32,7 +77,6 @@ class CompressionLevel(IntEnum):
     FASTEST = 0
     FAST = 1
     DEFAULT = 2
-    # We regard this as uncompressed.
     SLOWEST = 3
 
 
@@ -52,14 +96,15 @@ class Zlib:
             if f is None:
                 return
             cmf, flg = struct.unpack(self.FMT, f.read(2))
-            assert (flg | cmf << 8) % 31 == 0
+            if (flg | cmf << 8) % 31 != 0:
+                raise ValueError("incorrect header check")
             self.cm = CompressionMethod(cmf & 0b1111)
             cinfo = cmf >> 4 & 0b1111
             self.wbits = cinfo + 8
             self.fdict = flg >> 5 & 0b1
             self.flevel = CompressionLevel(flg >> 6 & 0b11)
             if self.fdict:
-                self.dictid = struct.unpack(self.FMT_DICT, f.read(4))
+                (self.dictid,) = struct.unpack(self.FMT_DICT, f.read(4))
 
         def __bytes__(self):
             cinfo = self.wbits - 8
@@ -84,11 +129,7 @@ class Zlib:
     FMT_TRAILER = "!I"
     FMT_UNCOMPHEADER = "<BHH"
 
-    class BlockType(IntEnum):
-        NONE = 0b00
-        HUFFMAN_FIXED = 0b01
-        HUFFMAN_DYNAMIC = 0b10
-        RESERVED = 0b11
+    BlockType = deflate.BlockType
 
     def __init__(self, f=None):
         if f is None:
@@ -96,7 +137,7 @@ class Zlib:
         self.header = self.Header(f)
         remainder = f.read()
         self.compressed_data = remainder[:-4]
-        self.adler32 = struct.unpack(self.FMT_TRAILER, remainder[-4:])
+        (self.adler32,) = struct.unpack(self.FMT_TRAILER, remainder[-4:])
 
     def __bytes__(self):
         data = bytearray()
@@ -105,123 +146,445 @@ class Zlib:
         data += struct.pack(self.FMT_TRAILER, self.adler32)
         return bytes(data)
 
-    def _setup_header(self, level, wbits):
+    def _setup_header(self, level, wbits, strategy=Z_DEFAULT_STRATEGY):
         self.header = self.Header()
         self.header.cm = CompressionMethod.DEFLATE
         self.header.wbits = wbits
-        # TODO: Refine the mapping from level [0, 9] to CompressionLevel [0, 3].
-        if level == Z_NO_COMPRESSION:
+        # This is the same mapping that zlib uses.
+        if level < 2 or strategy in (Z_HUFFMAN_ONLY, Z_RLE):
             self.header.flevel = CompressionLevel.FASTEST
-        else:
+        elif level < 6:
+            self.header.flevel = CompressionLevel.FAST
+        elif level == 6:
             self.header.flevel = CompressionLevel.DEFAULT
-        self.header.fdict = False
-
-    def __compress_nocompression(self, uncompressed_data):
-        """Copy the data with no compression."""
-        LEN = min(0b1111_1111, len(uncompressed_data))
-        NLEN = (~LEN) & 0b11111111_11111111
-        nblocks = math.ceil(len(uncompressed_data) / LEN)
-        self.compressed_data = bytearray()
-        for i in range(nblocks):
-            bfinal = i + 1 == nblocks
-            start = i * LEN
-            if bfinal:
-                LEN = len(uncompressed_data) - start
-                NLEN = (~LEN) & 0b11111111_11111111
-            btype = self.BlockType.NONE
-            bheader = bfinal | btype << 1
-            self.compressed_data += struct.pack(
-                self.FMT_UNCOMPHEADER, bheader, LEN, NLEN
-            )
-            if bfinal:
-                bdata = uncompressed_data[start:]
-            else:
-                bdata = uncompressed_data[start : (i + 1) * LEN]
-            assert len(bdata) == LEN
-            self.compressed_data += bdata
-
-    def __compress_huffmanfixed(self, uncompressed_f):
-        """Copy the data using the fixed Huffman codes, all in one block."""
-        import zlib
-
-        uncompressed_data = uncompressed_f.read()
-        buf = io.BytesIO()
-        bw = BitWriter(buf)
-        deflate_fixed = deflate.Deflate(deflate.fixed_llht, deflate.fixed_dht, bw)
-        bw.write_bits(True, 1)
-        bw.write_bits(self.BlockType.HUFFMAN_FIXED, 2)
-        for byte in uncompressed_data:
-            deflate_fixed.write_literal(byte)
-        deflate_fixed.write_end()
-        bw.flush()
-        self.compressed_data = buf.getvalue()
-        # TODO: Compute this as we go (like with the frequencies)
-        self.adler32 = zlib.adler32(uncompressed_data)
-
-    def __compress_huffmanfixed_lz(self, uncompressed_f):
-        """Copy the data using the fixed Huffman codes and LZ backreferences."""
-        import zlib
-
-        output_buf = io.BytesIO()
-        bw = BitWriter(output_buf)
-        deflate_fixed = deflate.Deflate(deflate.fixed_llht, deflate.fixed_dht, bw)
-        bw.write_bits(True, 1)
-        bw.write_bits(self.BlockType.HUFFMAN_FIXED, 2)
-        lz77.compress(uncompressed_f, deflate_fixed, 2**self.header.wbits)
-        deflate_fixed.write_end()
-        bw.flush()
-        self.compressed_data = output_buf.getvalue()
-        # TODO: Compute this as we go (like with the frequencies)
-        uncompressed_f.seek(0)
-        self.adler32 = zlib.adler32(uncompressed_f.read())
-
-    def __compress_slow(self, uncompressed_f):
-        """Copy the data using the dynamic Huffman codes, all in one block."""
-        pass
-
-    def _compress(self, f):
-        if self.header.flevel == CompressionLevel.FASTEST:
-            self.__compress_nocompression(f.read())
         else:
-            self.__compress_huffmanfixed(f)
-
-    def _decompress(self):
-        if self.header.fdict is True:
-            raise NotImplementedError()
-
-        # TODO return DECOMPRESSED data
-        return self.compressed_data
+            self.header.flevel = CompressionLevel.SLOWEST
+        self.header.fdict = False
 
 
-def compress(f, /, level=Z_DEFAULT_COMPRESSION, wbits=MAX_WBITS):
-    if level < Z_DEFAULT_COMPRESSION or level > Z_BEST_COMPRESSION:
+def _check_compress_args(level, wbits, strategy=Z_DEFAULT_STRATEGY, probe_distances=()):
+    if level < Z_DEFAULT_COMPRESSION or level > MAX_LEVEL:
         raise ValueError(f"invalid compression level {level}")
-    if wbits < 9 or wbits > MAX_WBITS:
+    if strategy not in tuple(lz77.Strategy):
+        raise ValueError(f"invalid strategy {strategy}")
+    if abs(wbits) < MIN_WBITS or abs(wbits) > MAX_WBITS:
         raise ValueError(f"invalid window bits {wbits}")
+    for distance in probe_distances:
+        if distance <= 0 or distance > 2 ** abs(wbits):
+            raise ValueError(f"invalid probe distance {distance}")
     if level == Z_DEFAULT_COMPRESSION:
         level = 6
+    return level
+
+
+class Compressor:
+    """Incremental compressor, in the style of zlib.compressobj.
+
+    Input is handed to compress() a chunk at a time, and the compressed stream
+    comes back out in pieces, so neither has to be held in full. At any point we
+    hold at most two windows of input, a block of LZ77 output, and whatever
+    compressed output has not yet been returned.
+
+    As with zlib, a negative wbits gives a raw DEFLATE stream, without the zlib
+    header and trailer. zdict primes the compressor with data that later input
+    is likely to repeat. The level sets how hard to look for matches, and the
+    strategy what sort of matches to look for. probe_distances are distances
+    that matches are especially likely at, to try first (see lz77.HashChain)."""
+
+    MAX_STORED = 2**16 - 1
+    """Largest amount of data that fits in a stored block."""
+
+    def __init__(
+        self,
+        level=Z_DEFAULT_COMPRESSION,
+        wbits=MAX_WBITS,
+        zdict=None,
+        strategy=Z_DEFAULT_STRATEGY,
+        probe_distances=(),
+    ):
+        level = _check_compress_args(level, wbits, strategy, probe_distances)
+        self.level = level
+        self.raw = wbits < 0
+        """Whether to leave out the zlib header and trailer."""
+        wbits = abs(wbits)
+        self.wbits = wbits
+        self.out = io.BytesIO()
+        """Compressed output that has yet to be returned."""
+        self.bw = BitWriter(self.out)
+        self.adler32 = adler32.adler32(b"")
+        """Running checksum of all of the input so far."""
+        self.finished = False
+        if level == Z_NO_COMPRESSION:
+            self.stored_buf = bytearray()
+            """Input waiting to be written as a stored block."""
+        else:
+            self.block_writer = deflate.BlockWriter(self.bw)
+            encoder = optimal.OptimalLz77 if CONFIGS[level].passes else lz77.Lz77
+            self.lz77 = encoder(
+                self.block_writer, 2**wbits, CONFIGS[level], strategy, probe_distances
+            )
+            if zdict is not None:
+                self.lz77.set_dictionary(zdict)
+        if not self.raw:
+            header = Zlib()
+            header._setup_header(level, wbits, strategy)
+            if zdict is not None:
+                header.header.fdict = True
+                header.header.dictid = adler32.adler32(zdict)
+            self.out.write(bytes(header.header))
+
+    def _take_output(self):
+        data = self.out.getvalue()
+        self.out.seek(0)
+        self.out.truncate()
+        return data
+
+    def _write_stored_block(self, data, bfinal):
+        self.bw.write_bits(bfinal, 1)
+        self.bw.write_bits(deflate.BlockType.NONE, 2)
+        self.bw.align()
+        self.bw.write_bytes(struct.pack("<HH", len(data), ~len(data) & 0xFFFF))
+        self.bw.write_bytes(data)
+
+    def compress(self, data):
+        """Compresses some input, returning any compressed data that is ready."""
+        if self.finished:
+            raise ValueError("compressor has already been finished")
+        self.adler32 = adler32.adler32(data, self.adler32)
+        if self.level == Z_NO_COMPRESSION:
+            self.stored_buf += data
+            while len(self.stored_buf) > self.MAX_STORED:
+                self._write_stored_block(self.stored_buf[: self.MAX_STORED], False)
+                del self.stored_buf[: self.MAX_STORED]
+        else:
+            self.lz77.feed(data)
+        return self._take_output()
+
+    def flush(self, mode=Z_FINISH):
+        """Compresses all pending input, and returns the compressed data.
+
+        Z_SYNC_FLUSH ends on a byte boundary, so that everything so far can be
+        decompressed. Z_FULL_FLUSH also makes later data not refer back to
+        anything before it. Z_FINISH ends the stream."""
+        if self.finished:
+            raise ValueError("compressor has already been finished")
+        if mode == Z_NO_FLUSH:
+            return b""
+        bfinal = mode == Z_FINISH
+        if self.level == Z_NO_COMPRESSION:
+            if self.stored_buf or bfinal:
+                self._write_stored_block(self.stored_buf, bfinal)
+                self.stored_buf.clear()
+        else:
+            if mode == Z_FULL_FLUSH:
+                self.lz77.reset()
+            else:
+                self.lz77.flush()
+            if bfinal:
+                self.block_writer.finish()
+            else:
+                self.block_writer.flush()
+        if bfinal:
+            self.bw.flush()
+            if not self.raw:
+                self.out.write(struct.pack(Zlib.FMT_TRAILER, self.adler32))
+            self.finished = True
+        else:
+            # An empty stored block gets us to a byte boundary. The (unfortunately
+            # still necessary) 4 bytes for its lengths are what zlib users
+            # know as the sync marker.
+            self._write_stored_block(b"", False)
+            self.bw.flush()
+        return self._take_output()
+
+
+def _compress_segment(data, dictionary, level, wbits, strategy, probes, final):
+    """Compresses one segment into raw DEFLATE, for ParallelCompressor.
+
+    Returns the compressed data and the segment's Adler-32."""
+    compressor = Compressor(level, -wbits, dictionary or None, strategy, probes)
+    compressed = compressor.compress(data)
+    compressed += compressor.flush(Z_FINISH if final else Z_SYNC_FLUSH)
+    return compressed, adler32.adler32(data)
+
+
+class ParallelCompressor:
+    """Compressor that spreads the work across a pool of processes.
+
+    Input is split into segments, each of which is compressed in its own process
+    as raw DEFLATE, primed with the window before it as a dictionary. Every
+    segment but the last ends with a sync flush, so that it ends on a byte
+    boundary, and the segments can simply be joined up behind a zlib header. The
+    checksums of the segments are combined into the one for the whole stream.
+
+    Priming means that the output is almost as small as with a single process.
+    At most two segments per process are held at a time. Only zlib streams are
+    supported, not raw ones.
+
+    The processes are shut down by flush(), or by close() if compression is
+    given up on. Used as a context manager, it is closed on the way out."""
+
+    def __init__(
+        self,
+        level=Z_DEFAULT_COMPRESSION,
+        wbits=MAX_WBITS,
+        jobs=None,
+        segment_size=SEGMENT_SIZE,
+        strategy=Z_DEFAULT_STRATEGY,
+        probe_distances=(),
+    ):
+        self.level = _check_compress_args(level, wbits, strategy, probe_distances)
+        if wbits < 0:
+            raise ValueError("raw streams can't be compressed in parallel")
+        self.wbits = wbits
+        self.strategy = strategy
+        self.probe_distances = probe_distances
+        self.jobs = jobs or os.cpu_count()
+        self.segment_size = segment_size
+        self.executor = ProcessPoolExecutor(self.jobs)
+        self.segment = bytearray()
+        """Input for the next segment."""
+        self.dictionary = b""
+        """End of the previous segment, to prime the next one with."""
+        self.pending = deque()
+        """Segments being compressed, oldest first, and their lengths."""
+        self.adler32 = adler32.adler32(b"")
+        self.finished = False
+        header = Zlib()
+        header._setup_header(self.level, wbits, strategy)
+        self.out = bytearray(bytes(header.header))
+        """Compressed output that has yet to be returned."""
+
+    def _submit(self, data, final):
+        future = self.executor.submit(
+            _compress_segment,
+            data,
+            self.dictionary,
+            self.level,
+            self.wbits,
+            self.strategy,
+            self.probe_distances,
+            final,
+        )
+        self.pending.append((future, len(data)))
+        self.dictionary = bytes(data[-(2**self.wbits) :])
+
+    def _collect(self, wait):
+        """Takes the output of segments that are done, in order.
+
+        If wait is set, waits until there are few enough segments left pending."""
+        while self.pending and (
+            self.pending[0][0].done() or (wait and len(self.pending) >= 2 * self.jobs)
+        ):
+            future, length = self.pending.popleft()
+            compressed, segment_adler32 = future.result()
+            self.out += compressed
+            self.adler32 = adler32.adler32_combine(
+                self.adler32, segment_adler32, length
+            )
 
-    zlib = Zlib()
-    zlib._setup_header(level, wbits)
-    zlib._compress(f)
-    print(f"Created ZLIB container: {zlib}")
-    return zlib
-
-
-def decompress(f, /, wbits=MAX_WBITS):
-    # TODO: support custom wbits (currently we take from the file)
-    if wbits != 0:
-        raise NotImplementedError()
-
-    zlib = Zlib(f)
-    print(f"Parsed ZLIB container: {zlib}")
-    return zlib._decompress()
+    def _take_output(self):
+        data = bytes(self.out)
+        self.out.clear()
+        return data
+
+    def compress(self, data):
+        """Compresses some input, returning any compressed data that is ready."""
+        if self.finished:
+            raise ValueError("compressor has already been finished")
+        self.segment += data
+        while len(self.segment) >= self.segment_size:
+            self._submit(bytes(self.segment[: self.segment_size]), False)
+            del self.segment[: self.segment_size]
+            self._collect(True)
+        self._collect(False)
+        return self._take_output()
+
+    def flush(self):
+        """Compresses all pending input, and returns the rest of the stream."""
+        if self.finished:
+            raise ValueError("compressor has already been finished")
+        self._submit(bytes(self.segment), True)
+        self.segment.clear()
+        while self.pending:
+            self.pending[0][0].result()
+            self._collect(False)
+        self.close()
+        self.out += struct.pack(Zlib.FMT_TRAILER, self.adler32)
+        self.finished = True
+        return self._take_output()
+
+    def close(self):
+        """Shuts down the processes, dropping any segments still to compress."""
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def compress(
+    f,
+    /,
+    level=Z_DEFAULT_COMPRESSION,
+    wbits=MAX_WBITS,
+    strategy=Z_DEFAULT_STRATEGY,
+    probe_distances=(),
+):
+    """Compresses everything read from a file-like object."""
+    compressor = Compressor(level, wbits, None, strategy, probe_distances)
+    data = bytearray()
+    while chunk := f.read(CHUNK_SIZE):
+        data += compressor.compress(chunk)
+    data += compressor.flush()
+    return Zlib(io.BytesIO(data))
+
+
+class Decompressor:
+    """Incremental decompressor, in the style of zlib.decompressobj.
+
+    Input can be handed to decompress() as it arrives, and output comes back as
+    soon as it is decoded. If max_length is given, any input that could not be
+    processed without going over it is left in unconsumed_tail, to be passed
+    back in later. Apart from that, at most a window of output is held onto."""
+
+    def __init__(self, wbits=MAX_WBITS, zdict=None):
+        if wbits != 0 and not MIN_WBITS <= abs(wbits) <= MAX_WBITS:
+            raise ValueError(f"invalid window bits {wbits}")
+        self.wbits = wbits
+        self.zdict = zdict
+        self.header_buf = bytearray()
+        """Start of the stream, while we are waiting for all of the header."""
+        self.inflater = None
+        self.adler32 = None
+        """Running checksum of all of the output so far."""
+        self.eof = False
+        """Whether the end of the stream has been reached."""
+        self.unconsumed_tail = b""
+        """Input that was not processed because of the output limit."""
+        self.unused_data = b""
+        """Input that came after the end of the stream."""
+        if wbits < 0:
+            self.inflater = inflate.Inflater(b"" if zdict is None else zdict)
+
+    def _read_header(self, data):
+        """Parses the header once all of it is here, and returns what follows."""
+        self.header_buf += data
+        header_size = 2
+        if len(self.header_buf) >= 2 and self.header_buf[1] >> 5 & 0b1:
+            header_size += 4
+        if len(self.header_buf) < header_size:
+            return b""
+        header = Zlib.Header(io.BytesIO(self.header_buf))
+        if header.cm != CompressionMethod.DEFLATE:
+            raise ValueError("unknown compression method")
+        if self.wbits != 0 and header.wbits > self.wbits:
+            raise ValueError("invalid window size")
+        dictionary = b""
+        if header.fdict:
+            if self.zdict is None:
+                raise ValueError("a preset dictionary is needed")
+            if adler32.adler32(self.zdict) != header.dictid:
+                raise ValueError("incorrect preset dictionary")
+            dictionary = self.zdict
+        self.inflater = inflate.Inflater(dictionary)
+        self.adler32 = adler32.adler32(b"")
+        return bytes(self.header_buf[header_size:])
+
+    def _read_trailer(self):
+        br = self.inflater.br
+        br.align()
+        if br.bits_left() < 32:
+            return
+        (expected,) = struct.unpack(Zlib.FMT_TRAILER, br.read_aligned(4))
+        if expected != self.adler32:
+            raise ValueError("incorrect data check")
+        self.eof = True
+
+    def decompress(self, data, max_length=0):
+        """Decompresses some input, returning the output that is ready."""
+        if max_length < 0:
+            raise ValueError("max_length must be non-negative")
+        if self.eof:
+            self.unused_data += data
+            return b""
+        if self.inflater is None:
+            data = self._read_header(data)
+            if self.inflater is None:
+                return b""
+        inflater = self.inflater
+        inflater.feed(data)
+        inflater.inflate(max_length)
+        out = inflater.take_output(max_length)
+        if self.adler32 is not None:
+            self.adler32 = adler32.adler32(out, self.adler32)
+        self.unconsumed_tail = b""
+        if inflater.eof and inflater.start == inflater.pos:
+            if self.adler32 is None:
+                self.eof = True
+            else:
+                self._read_trailer()
+            if self.eof:
+                self.unused_data = inflater.br.unload()
+        elif max_length and inflater.pos - inflater.start + len(out) >= max_length:
+            # We stopped because of the output limit, so any input left over
+            # goes back to the caller.
+            self.unconsumed_tail = inflater.br.unload()
+        return out
+
+    def flush(self):
+        """Returns any output that is still pending, with no limit."""
+        return self.decompress(self.unconsumed_tail)
+
+
+def decompress(f, /, wbits=MAX_WBITS, zdict=None):
+    """Decompresses a zlib stream, or a raw DEFLATE stream if wbits is negative.
+
+    If wbits is 0, the window size is taken from the header. Otherwise, the
+    window size in the header must not be larger than wbits."""
+    decompressor = Decompressor(wbits, zdict)
+    data = bytearray()
+    while chunk := f.read(CHUNK_SIZE):
+        data += decompressor.decompress(chunk)
+        if decompressor.eof:
+            break
+    if not decompressor.eof:
+        raise ValueError("incomplete or truncated stream")
+    return bytes(data)
 
 
 def main():
+    import random
     import sys
     import zlib
 
+    print("Test streaming decompression, in chunks of every size:")
+    rng = random.Random(0)
+    data = bytes(rng.choices(b"abcdefgh \n", k=20000))
+    compressor = zlib.compressobj(6)
+    flushed = compressor.compress(data[:5000]) + compressor.flush(Z_SYNC_FLUSH)
+    flushed += compressor.compress(data[5000:12000]) + compressor.flush(Z_FULL_FLUSH)
+    flushed += compressor.compress(data[12000:]) + compressor.flush()
+    compressor = zlib.compressobj(6, wbits=9)
+    small_window = compressor.compress(data) + compressor.flush()
+    for compressed in [flushed, small_window]:
+        for chunk_size in range(1, 41):
+            for max_length in [0, 100]:
+                decompressor = Decompressor()
+                out = bytearray()
+                for i in range(0, len(compressed), chunk_size):
+                    chunk = (
+                        decompressor.unconsumed_tail + compressed[i : i + chunk_size]
+                    )
+                    out += decompressor.decompress(chunk, max_length)
+                while decompressor.unconsumed_tail:
+                    chunk = decompressor.unconsumed_tail
+                    out += decompressor.decompress(chunk, max_length)
+                out += decompressor.flush()
+                assert out == data and decompressor.eof, (chunk_size, max_length)
+
     path_in = "sample/deflate_fixed.png"
     if len(sys.argv) > 1:
         path_in = sys.argv[1]